@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import ChatMessage, CustomUser
+from .models import ChatMessage, Connection, ConnectionRequest, CustomUser, MessageTranslation
 
 admin.site.register(ChatMessage)
-admin.site.register(CustomUser)
\ No newline at end of file
+admin.site.register(MessageTranslation)
+admin.site.register(CustomUser)
+admin.site.register(ConnectionRequest)
+admin.site.register(Connection)
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from redis.exceptions import RedisError
+from .redis import get_redis
+
+
+class LRUCache:
+    # Bounded in-process cache with per entry expiry
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def normalize_text(text):
+    # Canonical form used for cache keys: NFC with collapsed whitespace
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+class TranslationCache:
+    # Two tiers: a per process LRU in front of an optional Redis shared by
+    # every worker. Values are whole translation results, so cached answers
+    # carry the same pronunciation and detected_language as fresh ones.
+    def __init__(self, max_size=10000, ttl=3600, redis_ttl=86400, use_redis=True):
+        self.local = LRUCache(max_size=max_size, ttl=ttl)
+        self.redis_ttl = redis_ttl
+        self.use_redis = use_redis
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self.redis_errors = 0
+
+    def make_key(self, text, dest, src='auto'):
+        digest = hashlib.sha1(normalize_text(text).encode()).hexdigest()
+        return f'translation:{src}:{dest}:{digest}'
+
+    def get_local(self, text, dest, src='auto'):
+        value = self.local.get(self.make_key(text, dest, src))
+        return dict(value) if value is not None else None
+
+    async def get(self, text, dest, src='auto'):
+        key = self.make_key(text, dest, src)
+        value = self.local.get(key)
+        if value is not None:
+            return dict(value)
+
+        redis = get_redis() if self.use_redis else None
+        if redis is None:
+            return None
+        try:
+            data = await redis.get(key)
+        except (RedisError, OSError):
+            self.redis_errors += 1
+            return None
+        if data is None:
+            self.redis_misses += 1
+            return None
+        self.redis_hits += 1
+        value = json.loads(data)
+        self.local.set(key, value)
+        return dict(value)
+
+    async def set(self, text, dest, result, src='auto'):
+        key = self.make_key(text, dest, src)
+        value = dict(result)
+        self.local.set(key, value)
+
+        redis = get_redis() if self.use_redis else None
+        if redis is None:
+            return
+        try:
+            await redis.set(key, json.dumps(value), ex=self.redis_ttl)
+        except (RedisError, OSError):
+            self.redis_errors += 1
+
+    def stats(self):
+        return {
+            'local': self.local.stats(),
+            'redis': {
+                'hits': self.redis_hits,
+                'misses': self.redis_misses,
+                'errors': self.redis_errors,
+            },
+        }
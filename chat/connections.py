@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.db import transaction
+from .models import Connection, ConnectionRequest
+
+
+CONNECTIONS_PAGE_SIZE = getattr(settings, 'CONNECTIONS_PAGE_SIZE', 50)
+CONNECTIONS_MAX_PAGE_SIZE = getattr(settings, 'CONNECTIONS_MAX_PAGE_SIZE', 200)
+
+
+def send_request(sender, receiver):
+    # Idempotent: sending the same request again returns the existing one.
+    # A rejected request is reopened. Returns (request, created, reopened).
+    if sender.pk == receiver.pk:
+        raise ValueError('You cannot connect with yourself')
+
+    connection_request, created = ConnectionRequest.objects.get_or_create(sender=sender, receiver=receiver)
+    reopened = not created and connection_request.status == 'rejected'
+    if reopened:
+        connection_request.status = 'pending'
+        connection_request.save(update_fields=['status'])
+    return connection_request, created, reopened
+
+
+@transaction.atomic
+def accept_requests(user, request_ids):
+    # Accept the pending requests sent to user, and record both directions
+    # of each new connection in one bulk insert
+    pending = ConnectionRequest.objects.select_for_update().filter(
+        id__in=request_ids, receiver=user, status='pending'
+    )
+    accepted = list(pending.values_list('id', 'sender_id'))
+    if not accepted:
+        return []
+
+    ConnectionRequest.objects.filter(id__in=[pk for pk, _ in accepted]).update(status='accepted')
+    connections = []
+    for _, sender_id in accepted:
+        connections.append(Connection(user_id=user.pk, friend_id=sender_id))
+        connections.append(Connection(user_id=sender_id, friend_id=user.pk))
+    Connection.objects.bulk_create(connections, ignore_conflicts=True)
+    return accepted
+
+
+def reject_requests(user, request_ids):
+    pending = ConnectionRequest.objects.filter(id__in=request_ids, receiver=user, status='pending')
+    rejected = list(pending.values_list('id', 'sender_id'))
+    ConnectionRequest.objects.filter(id__in=[pk for pk, _ in rejected]).update(status='rejected')
+    return rejected
+
+
+def paginate(queryset, before=None, limit=CONNECTIONS_PAGE_SIZE):
+    # Keyset pagination on id, newest first
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    items = list(queryset.order_by('-id')[:limit + 1])
+    next_cursor = items[limit - 1].id if len(items) > limit else None
+    return items[:limit], next_cursor
+
+
+def list_connections(user, before=None, limit=CONNECTIONS_PAGE_SIZE):
+    queryset = Connection.objects.filter(user=user).select_related('friend')
+    return paginate(queryset, before, limit)
+
+
+def list_incoming_requests(user, before=None, limit=CONNECTIONS_PAGE_SIZE):
+    queryset = ConnectionRequest.objects.filter(receiver=user, status='pending').select_related('sender', 'receiver')
+    return paginate(queryset, before, limit)
+
+
+def list_outgoing_requests(user, before=None, limit=CONNECTIONS_PAGE_SIZE):
+    queryset = ConnectionRequest.objects.filter(sender=user, status='pending').select_related('sender', 'receiver')
+    return paginate(queryset, before, limit)
+
+
+def list_mutual_connections(user, other, before=None, limit=CONNECTIONS_PAGE_SIZE):
+    # Connections of user who are also connected with other, as one
+    # semi-join over the (user, friend) index
+    queryset = Connection.objects.filter(
+        user=user,
+        friend__in=Connection.objects.filter(user=other).values('friend'),
+    ).select_related('friend')
+    return paginate(queryset, before, limit)
+
+
+def get_friend_ids(user_id):
+    return list(Connection.objects.filter(user_id=user_id).values_list('friend_id', flat=True))
@@ -1,32 +1,145 @@
 import json
-import aiohttp
+import logging
+import uuid
+import asyncio
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.utils import timezone
 from urllib.parse import parse_qs
+from .connections import get_friend_ids
+from .fanout import (detected_language, display_translations, get_source_language, set_source_language,
+                     translate_for_languages, TRANSLATION_DELIVERY_TIMEOUT)
+from .history import (build_translation, get_room_history, get_translations, schedule_backfill,
+                      HISTORY_REPLAY_MAX)
+from .metrics import (timed, CHAT_DEFERRED_TRANSLATIONS, CHAT_FANOUT_LANGUAGES, CHAT_FANOUT_LATENCY,
+                      CHAT_RECEIVE_LATENCY, GROUP_SEND_LATENCY, WEBSOCKET_CONNECTIONS)
+from .models import ChatMessage
+from .notifications import (apublish_many, coalesce_events, presence_event, presence_room_name,
+                            user_group_name, NOTIFICATION_BATCH_SIZE, NOTIFICATION_BATCH_WINDOW)
+from .outbound import OutboundQueue
+from .persistence import get_message_writer
+from .presence import get_presence_registry
+from .protocol import build_envelope, select_codec, ProtocolError
+from .recent import get_room_buffer, translate_entries
+from .translate import display_text, get_translation_service
+
+logger = logging.getLogger(__name__)
+
+# Keep references to translations finishing after their message was
+# delivered, so they aren't garbage collected
+_follow_ups = set()
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    # A class variable to keep track of user languages
-    user_languages = {}
 
+def _follow_up_done(task):
+    _follow_ups.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Error sending deferred translations", exc_info=task.exception())
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = f"chat_{self.room_name}"
+        WEBSOCKET_CONNECTIONS.inc(consumer="chat")
 
         # Extract language from query parameters
         query_string = self.scope['query_string'].decode()
-        self.preferred_language = parse_qs(query_string).get('lang', ['en'])[0]
+        query = parse_qs(query_string)
+        self.preferred_language = query.get('lang', ['en'])[0]
+
+        # JSON text frames, or msgpack binary frames if the client asked for
+        # them with a subprotocol or ?format=msgpack
+        self.codec = select_codec(self.scope, query)
+        self.seq = 0
+        self.outbound = OutboundQueue(self)
+
+        # The sender is assumed to write in the language they read, until
+        # the translator detects otherwise. The detected language is kept
+        # for the session and per user, so it isn't detected again.
+        self.detected_language = await get_source_language(self.get_sender_id(), self.preferred_language)
 
         # Join room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
 
-        # Store user language preference
-        self.user_languages[self.channel_name] = self.preferred_language
+        # Store user language preference in the cluster wide presence registry
+        self.presence = get_presence_registry()
+        is_new_language = self.preferred_language not in await self.presence.languages(self.room_group_name)
+        await self.presence.join(self.room_group_name, self.channel_name, self.preferred_language)
 
-        await self.accept()
+        # First member reading the room in this language: translate its
+        # recent history in the background, in bulk
+        if is_new_language:
+            schedule_backfill(self.room_name, self.preferred_language)
+
+        await self.accept(subprotocol=self.codec.subprotocol)
+
+        # Replay the last N messages of the room if the client asked for them
+        try:
+            history = int(query.get('history', ['0'])[0])
+        except ValueError:
+            history = 0
+        if history > 0:
+            await self.send_history(min(history, HISTORY_REPLAY_MAX))
+
+        # Resuming after a dropped connection: replay only the messages sent
+        # since the last sequence number the client saw
+        try:
+            since = int(query['since'][0])
+        except (KeyError, ValueError):
+            since = None
+        if since is not None:
+            await self.send_missed(since)
+
+    async def send_history(self, limit):
+        messages, _ = await get_room_history(self.room_name, limit=limit)
+        messages.reverse()  # Oldest first, as they were delivered
+        translations = await get_translations(messages, self.preferred_language)
+        await self.send_envelopes([
+            self.build_envelope(
+                message.uid and message.uid.hex, message.language, translation or message.content,
+                message.content, history=True,
+            )
+            for message, translation in zip(messages, translations)
+        ])
+
+    async def send_missed(self, since):
+        entries, truncated, reset = await get_room_buffer().since(self.room_name, since)
+        texts = await translate_entries(entries, self.preferred_language)
+        envelopes = [
+            self.build_envelope(
+                entry['id'], entry['language'], text, entry['message'], room_seq=entry['seq'], replay=True,
+            )
+            for entry, text in zip(entries, texts)
+        ]
+        # Older messages were missed too, the client has to fetch them from
+        # the room history. With nothing to replay the flags go out alone.
+        if truncated:
+            if not envelopes:
+                envelopes.append(self.build_envelope(None, None, None, None, replay=True))
+            envelopes[0]['truncated'] = True
+            if reset:
+                envelopes[0]['reset'] = True
+        await self.send_envelopes(envelopes)
+
+    def build_envelope(self, uid, source_language, message, original, **extra):
+        # Envelopes are numbered per connection so clients can spot gaps
+        self.seq += 1
+        return build_envelope(
+            uid, self.seq, self.room_name, self.preferred_language, source_language, message, original, **extra
+        )
+
+    async def send_envelopes(self, envelopes):
+        if not envelopes:
+            return
+        for frame in self.codec.encode(envelopes):
+            await self.send(**frame)
 
     async def disconnect(self, close_code):
+        WEBSOCKET_CONNECTIONS.dec(consumer="chat")
+        self.outbound.close()
+
         # Remove user language preference
-        if self.channel_name in self.user_languages:
-            del self.user_languages[self.channel_name]
+        await self.presence.leave(self.room_group_name, self.channel_name)
 
         # Leave room group
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
@@ -44,49 +157,272 @@ class ChatConsumer(AsyncWebsocketConsumer):
     #             else:
     #                 return response_data.get("translated_text", message)
 
-    async def translate_message(self, message, dest_language):
-        async with aiohttp.ClientSession() as session:
-            # Prepare the payload with the expected keys
-            payload = {"input_text": message, "dest": dest_language}
-            
-            # Assuming the Django server is running on localhost and port 8000
-            # Change the URL to match your setup
-            url = 'http://localhost:8000/chat/api/translate/'
-            
-            async with session.post(url, json=payload) as response:
-                # Check if the response status is 200 OK before proceeding
-                if response.status == 200:
-                    response_data = await response.json()
-                    
-                    # Check for pronunciation, else fall back to translated text
-                    pronunciation = response_data.get("pronunciation")
-                    if pronunciation:
-                        return pronunciation
-                    else:
-                        return response_data.get("translated_text", message)
-                else:
-                    # Handle error or unexpected response
-                    print(f"Error: {response.status}")
-                    return message  # Fall back to the original message if the translation fails
+    async def translate_message(self, message, dest_language, src='auto'):
+        # Translate in process instead of calling back into our own HTTP API
+        try:
+            result = await get_translation_service().translate(message, dest_language, src)
+        except Exception as e:
+            logger.warning("Error translating a message into %s: %s", dest_language, e)
+            return message  # Fall back to the original message if the translation fails
 
+        # Check for pronunciation, else fall back to translated text
+        return display_text(result, message)
+
+    async def translate_in_time(self, message, dest_language, src='auto'):
+        # Translating here holds up every later message to the client, so
+        # it gets the same deadline as the sender's translations
+        try:
+            return await asyncio.wait_for(
+                self.translate_message(message, dest_language, src), TRANSLATION_DELIVERY_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            return message
+
+    @property
+    def source_language(self):
+        return self.detected_language or self.preferred_language
+
+    async def remember_source_language(self, message, results):
+        language = detected_language(message, results)
+        if language:
+            self.detected_language = language
+            await set_source_language(self.get_sender_id(), self.preferred_language, language)
+
+    async def get_room_languages(self):
+        # Distinct preferred languages of the members of this room, across
+        # every worker
+        return await self.presence.languages(self.room_group_name)
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
+    @timed(CHAT_RECEIVE_LATENCY)
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+            message = data["message"]
+            if not isinstance(message, str):
+                raise TypeError(f"message must be a string, not {type(message).__name__}")
+        except (ProtocolError, KeyError, TypeError) as e:
+            logger.info("Error decoding frame: %s", e)
+            return
+        uid = uuid.uuid4()
+        room_buffer = get_room_buffer()
+        room_seq = await room_buffer.next_seq(self.room_name)
+
+        # Translate once per language in the room, then send every version
+        # to the room group so each consumer picks its own
+        # Readers of the source language get the message as is. The
+        # translator is only told the source once it was detected, not
+        # while it is assumed from the sender's preferred language.
+        source_language = self.source_language
+        src = self.detected_language or 'auto'
+        with CHAT_FANOUT_LATENCY.time():
+            languages = await self.get_room_languages()
+            CHAT_FANOUT_LANGUAGES.observe(len(languages))
+            translation = asyncio.ensure_future(translate_for_languages(
+                message, languages, src=src, source_language=source_language,
+            ))
+            # A slow translator doesn't hold the message back: past the
+            # deadline it goes out in the original, translations follow
+            done, _ = await asyncio.wait([translation], timeout=TRANSLATION_DELIVERY_TIMEOUT)
+            pending = not done
+            results = {} if pending else translation.result()
+            translations = display_translations(message, results)
+            translations[source_language] = message
+            with GROUP_SEND_LATENCY.time(consumer="chat"):
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    {
+                        "type": "chat.message",
+                        "id": uid.hex,
+                        "room_seq": room_seq,
+                        "language": source_language,
+                        "src": src,
+                        "message": message,
+                        "translations": translations,
+                        "pending": pending,
+                    },
+                )
+
+        # Keep it in the room's recent messages for clients that reconnect.
+        # Deferred translations aren't in it, replays translate those again.
+        await room_buffer.append(self.room_name, room_seq, uid.hex, source_language, src, message, translations)
 
-        # Send message to room group without translating here
+        if pending:
+            CHAT_DEFERRED_TRANSLATIONS.inc()
+            task = asyncio.get_running_loop().create_task(
+                self.send_follow_up(translation, uid, room_seq, source_language, src, message)
+            )
+            _follow_ups.add(task)
+            task.add_done_callback(_follow_up_done)
+            return
+        await self.store_message(uid, source_language, src, message, results)
+
+    async def send_follow_up(self, translation, uid, room_seq, source_language, src, message):
+        # Sends the translations of a message delivered in the original
+        try:
+            results = await translation
+        except Exception as e:
+            logger.warning("Error translating a message: %s", e)
+            results = {}
+        translations = display_translations(message, results)
+        translations[source_language] = message
         await self.channel_layer.group_send(
-            self.room_group_name, {"type": "chat.message", "message": message}
+            self.room_group_name,
+            {
+                "type": "chat.translation",
+                "id": uid.hex,
+                "room_seq": room_seq,
+                "language": source_language,
+                "src": src,
+                "message": message,
+                "translations": translations,
+            },
+        )
+        await self.store_message(uid, source_language, src, message, results)
+
+    async def store_message(self, uid, source_language, src, message, results):
+        if self.detected_language is None and results:
+            await self.remember_source_language(message, results)
+
+        # Store the message and its translations through the write-behind
+        # buffer, off the delivery path
+        chat_message = ChatMessage(
+            room=self.room_name,
+            sender_id=self.get_sender_id(),
+            language=source_language,
+            language_detected=src != 'auto',
+            content=message,
+            timestamp=timezone.now(),
+            uid=uid,
         )
+        get_message_writer().write(chat_message, [
+            build_translation(chat_message, language, result)
+            for language, result in results.items()
+            if result is not None
+        ])
+
+    def get_sender_id(self):
+        user = self.scope.get("user")
+        if user is not None and user.is_authenticated:
+            return user.pk
+        return None
 
     # Receive message from room group
     async def chat_message(self, event):
         message = event["message"]
+        translations = event.get("translations", {})
+
+        # Use the version already translated for the user's preferred language,
+        # translating here only if the sender did not know about that language
+        # and the client is keeping up. While the sender's translations are
+        # still pending the original goes out, marked as such.
+        source_language = event.get("language", "")
+        pending = False
+        if self.preferred_language in translations:
+            translated_message = translations[self.preferred_language]
+        elif self.preferred_language == source_language or self.outbound.degraded:
+            translated_message = message
+        elif event.get("pending"):
+            translated_message = message
+            pending = True
+        else:
+            translated_message = await self.translate_in_time(
+                message, self.preferred_language, event.get("src", "auto"),
+            )
+
+        extra = {"pending": True} if pending else {}
+        # Queue the message for the WebSocket, bursts go out in one frame
+        self.outbound.put(
+            self.build_envelope(
+                event.get("id"), source_language, translated_message, message, room_seq=event.get("room_seq"),
+                **extra,
+            )
+        )
+
+    # Receive the deferred translations of a message from room group
+    async def chat_translation(self, event):
+        source_language = event.get("language", "")
+        if self.preferred_language == source_language or self.outbound.degraded:
+            return
+        message = event["message"]
+        translated_message = event["translations"].get(self.preferred_language)
+        if translated_message is None:
+            translated_message = await self.translate_in_time(
+                message, self.preferred_language, event.get("src", "auto"),
+            )
+
+        # Replaces the text of the message with the same id
+        self.outbound.put(
+            self.build_envelope(
+                event.get("id"), source_language, translated_message, message, room_seq=event.get("room_seq"),
+                update=True,
+            )
+        )
+
+
+class NotificationConsumer(AsyncWebsocketConsumer):
+    # Pushes connection request and friend presence events to a user,
+    # coalesced into batches so a busy user isn't flooded with tiny frames
+    async def connect(self):
+        user = self.scope.get("user")
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+
+        self.user_id = user.pk
+        self.group_name = user_group_name(self.user_id)
+        WEBSOCKET_CONNECTIONS.inc(consumer="notifications")
+        self.presence_room = presence_room_name(self.user_id)
+        self.pending_events = []
+        self.flush_handle = None
+
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+        # Tell friends the user came online, unless another connection of
+        # the user already did
+        self.presence = get_presence_registry()
+        await self.presence.join(self.presence_room, self.channel_name, "")
+        if await self.presence.member_count(self.presence_room) == 1:
+            await self.publish_presence("friend.online")
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, "group_name"):
+            return
+        WEBSOCKET_CONNECTIONS.dec(consumer="notifications")
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+        await self.presence.leave(self.presence_room, self.channel_name)
+        if await self.presence.member_count(self.presence_room) == 0:
+            await self.publish_presence("friend.offline")
+
+    async def publish_presence(self, event_type):
+        # Only friends with a notification socket open can receive the event
+        friend_ids = await database_sync_to_async(get_friend_ids)(self.user_id)
+        online = await self.presence.occupied([presence_room_name(friend_id) for friend_id in friend_ids])
+        event = presence_event(event_type, self.user_id)
+        await apublish_many(
+            [(friend_id, event) for friend_id in friend_ids if presence_room_name(friend_id) in online],
+            self.channel_layer,
+        )
 
-        # Translate the message to the user's preferred language
-        user_language = self.user_languages.get(self.channel_name, 'en')
-        translated_message = await self.translate_message(message, user_language)
+    # Receive an event for this user from the channel layer
+    async def notification_event(self, event):
+        self.pending_events.append(event["event"])
+        if len(self.pending_events) >= NOTIFICATION_BATCH_SIZE:
+            await self.flush_events()
+        elif self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(
+                NOTIFICATION_BATCH_WINDOW, lambda: loop.create_task(self.flush_events())
+            )
 
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({"message": translated_message}))
+    async def flush_events(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        events, self.pending_events = coalesce_events(self.pending_events), []
+        if events:
+            await self.send(text_data=json.dumps({"events": events}))
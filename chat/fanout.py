@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from redis.exceptions import RedisError
+from .metrics import TRANSLATION_SHORT_CIRCUITS
+from .translate import display_text, get_translation_service
+
+logger = logging.getLogger(__name__)
+
+
+SOURCE_LANGUAGE_CACHE_TTL = getattr(settings, 'SOURCE_LANGUAGE_CACHE_TTL', 24 * 60 * 60)  # seconds
+# Shorter messages are too ambiguous to trust their detected language
+SOURCE_LANGUAGE_MIN_LENGTH = getattr(settings, 'SOURCE_LANGUAGE_MIN_LENGTH', 20)  # characters
+# How long a chat message waits for its translations. Past it the message
+# goes out in the original and its translations follow in a second frame.
+TRANSLATION_DELIVERY_TIMEOUT = getattr(settings, 'TRANSLATION_DELIVERY_TIMEOUT', 0.5)  # seconds
+
+
+async def translate_for_languages(message, languages, service=None, src='auto', source_language=None):
+    # Translate the message once per distinct target language, in a single
+    # batch, so the cost of a room message grows with its languages, not
+    # its members. Languages whose translation failed map to None. The
+    # source language itself is never sent to the translator.
+    service = service or get_translation_service()
+    languages = list(dict.fromkeys(languages))
+    if source_language in languages:
+        languages.remove(source_language)
+        TRANSLATION_SHORT_CIRCUITS.inc()
+    if not languages:
+        return {}
+
+    [item] = await service.translate_batch([message], languages, src)
+
+    results = {}
+    for language in languages:
+        results[language] = item['translations'].get(language)
+        if results[language] is None:
+            logger.warning("Error translating a message into %s: %s", language, item['errors'].get(language))
+    return results
+
+
+def display_translations(message, results):
+    # Text to deliver per language, falling back to the original message if
+    # the translation failed
+    return {
+        language: display_text(result, message) if result else message
+        for language, result in results.items()
+    }
+
+
+async def translate_from_sources(items, language, service=None):
+    # items are (text, source_language) pairs. Texts are batched per source
+    # language so the translator is told the source instead of detecting it
+    # again. Returns translate_batch items in the order of items.
+    service = service or get_translation_service()
+    groups = {}
+    for i, (text, source_language) in enumerate(items):
+        groups.setdefault(source_language or 'auto', []).append(i)
+
+    batches = await asyncio.gather(*(
+        service.translate_batch([items[i][0] for i in indexes], [language], src)
+        for src, indexes in groups.items()
+    ))
+    results = [None] * len(items)
+    for indexes, batch in zip(groups.values(), batches):
+        for i, result in zip(indexes, batch):
+            results[i] = result
+    return results
+
+
+def detected_language(message, results):
+    # Source language the translator detected for a message, from any of
+    # its translations
+    if len(message) < SOURCE_LANGUAGE_MIN_LENGTH:
+        return None
+    for result in results.values():
+        if result and result.get('detected_language'):
+            return result['detected_language']
+    return None
+
+
+def source_language_key(user_id, language):
+    return f'source_language:{user_id}:{language}'
+
+
+async def get_source_language(user_id, language):
+    # What a sender reading in language was last detected writing in
+    # Unknown, and detected again, if the cache is unavailable
+    if user_id is None:
+        return None
+    try:
+        return await cache.aget(source_language_key(user_id, language))
+    except (RedisError, OSError) as e:
+        logger.warning("Error reading the source language of user %s: %s", user_id, e)
+        return None
+
+
+async def set_source_language(user_id, language, source_language):
+    if user_id is None:
+        return
+    try:
+        await cache.aset(source_language_key(user_id, language), source_language, SOURCE_LANGUAGE_CACHE_TTL)
+    except (RedisError, OSError) as e:
+        logger.warning("Error storing the source language of user %s: %s", user_id, e)
@@ -0,0 +1,140 @@
+import asyncio
+import base64
+import logging
+from datetime import datetime
+from django.conf import settings
+from django.db.models import Q
+from .fanout import translate_from_sources
+from .limits import Saturated
+from .models import ChatMessage, MessageTranslation
+from .translate import display_text
+
+logger = logging.getLogger(__name__)
+
+
+HISTORY_PAGE_SIZE = getattr(settings, 'HISTORY_PAGE_SIZE', 50)
+HISTORY_MAX_PAGE_SIZE = getattr(settings, 'HISTORY_MAX_PAGE_SIZE', 200)
+HISTORY_REPLAY_MAX = getattr(settings, 'HISTORY_REPLAY_MAX', 50)
+HISTORY_BACKFILL_SIZE = getattr(settings, 'HISTORY_BACKFILL_SIZE', 200)
+
+
+def encode_cursor(message):
+    value = f'{message.timestamp.isoformat()}|{message.pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything that isn't a cursor we produced
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (TypeError, UnicodeError, base64.binascii.Error) as e:
+        raise ValueError(f'Invalid cursor: {e}')
+
+
+async def get_room_history(room, before=None, limit=HISTORY_PAGE_SIZE):
+    # Keyset pagination over the (room, timestamp, id) index: each page
+    # starts strictly after the previous page's last row, so the cost of a
+    # page doesn't depend on how deep into the history it is
+    queryset = ChatMessage.objects.filter(room=room)
+    if before is not None:
+        timestamp, pk = before
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+
+    messages = [message async for message in queryset.order_by('-timestamp', '-id')[:limit + 1]]
+    next_cursor = encode_cursor(messages[limit - 1]) if len(messages) > limit else None
+    return messages[:limit], next_cursor
+
+
+def build_translation(message, language, result):
+    return MessageTranslation(
+        message=message,
+        language=language,
+        text=result['translated_text'],
+        pronunciation=result['pronunciation'] or '',
+    )
+
+
+async def get_translations(messages, language, limiter=None):
+    # Stored translations first, then the translation cache and only then
+    # the translator, in one batch. New translations are stored for next time.
+    # Messages written in the language are their own translation. With a
+    # limiter the batch takes one of its slots, and when it is saturated the
+    # missing translations are left out.
+    translations = {m.pk: m.content for m in messages if m.language == language}
+
+    pending = [m for m in messages if m.pk not in translations]
+    if pending:
+        stored = MessageTranslation.objects.filter(message__in=[m.pk for m in pending], language=language)
+        async for translation in stored:
+            translations[translation.message_id] = translation.pronunciation or translation.text
+
+    missing = [m for m in pending if m.pk not in translations]
+    if missing and limiter is None:
+        translations.update(await translate_and_store(missing, language))
+    elif missing:
+        try:
+            async with limiter.acquire():
+                translations.update(await translate_and_store(missing, language))
+        except Saturated as e:
+            logger.warning("Skipping %d history translations: %s", len(missing), e)
+
+    return [translations.get(m.pk) for m in messages]
+
+
+async def translate_and_store(messages, language):
+    items = await translate_from_sources([(m.content, m.source) for m in messages], language)
+
+    translations = {}
+    rows = []
+    for message, item in zip(messages, items):
+        result = item['translations'].get(language)
+        if result is None:
+            continue
+        translations[message.pk] = display_text(result, message.content)
+        rows.append(build_translation(message, language, result))
+    await MessageTranslation.objects.abulk_create(rows, ignore_conflicts=True)
+    return translations
+
+
+async def backfill_translations(room, language, limit=HISTORY_BACKFILL_SIZE):
+    # Translate the recent messages of a room that don't have a stored
+    # translation in the language yet
+    queryset = (
+        ChatMessage.objects.filter(room=room)
+        .exclude(language=language)
+        .exclude(translations__language=language)
+        .order_by('-timestamp', '-id')
+    )
+    messages = [message async for message in queryset[:limit]]
+    if messages:
+        await translate_and_store(messages, language)
+
+
+# Keep references to running backfills so they aren't garbage collected
+_backfills = set()
+
+
+def schedule_backfill(room, language):
+    task = asyncio.get_running_loop().create_task(backfill_translations(room, language))
+    _backfills.add(task)
+    task.add_done_callback(_backfill_done)
+    return task
+
+
+def _backfill_done(task):
+    _backfills.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Error backfilling translations", exc_info=task.exception())
+
+
+def serialize_message(message, translation=None):
+    return {
+        'id': message.pk,
+        'room': message.room,
+        'sender': message.sender_id,
+        'language': message.language,
+        'message': message.content,
+        'translation': translation,
+        'timestamp': message.timestamp.isoformat(),
+    }
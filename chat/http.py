@@ -0,0 +1,45 @@
+import asyncio
+import aiohttp
+from django.conf import settings
+from .lifespan import on_shutdown
+
+
+TRANSLATE_HTTP_POOL_SIZE = getattr(settings, 'TRANSLATE_HTTP_POOL_SIZE', 100)
+TRANSLATE_HTTP_KEEPALIVE = getattr(settings, 'TRANSLATE_HTTP_KEEPALIVE', 30)  # seconds
+TRANSLATE_HTTP_TIMEOUT = getattr(settings, 'TRANSLATE_HTTP_TIMEOUT', 10)  # seconds
+
+# One session per process, shared by every consumer. It is created lazily
+# because aiohttp needs a running event loop to build it.
+_session = None
+_session_loop = None
+
+
+def get_session():
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=TRANSLATE_HTTP_POOL_SIZE,
+            keepalive_timeout=TRANSLATE_HTTP_KEEPALIVE,
+            ttl_dns_cache=300,
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=TRANSLATE_HTTP_TIMEOUT),
+        )
+        _session_loop = loop
+    return _session
+
+
+def request_timeout(seconds=None):
+    # Per-request timeout, defaulting to the session wide one
+    return aiohttp.ClientTimeout(total=seconds or TRANSLATE_HTTP_TIMEOUT)
+
+
+@on_shutdown
+async def close_session():
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _session_loop = None
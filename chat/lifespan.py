@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Callbacks to run when the ASGI server shuts the application down
+_shutdown_callbacks = []
+_shut_down = False
+
+
+def on_shutdown(callback):
+    _shutdown_callbacks.append(callback)
+    return callback
+
+
+async def run_shutdown_callbacks():
+    # Once, whichever of the lifespan protocol or the reactor trigger
+    # comes first
+    global _shut_down
+    if _shut_down:
+        return
+    _shut_down = True
+    for callback in _shutdown_callbacks:
+        try:
+            await callback()
+        except Exception:
+            logger.exception("Error during shutdown")
+
+
+class LifespanApp:
+    # Handles the ASGI lifespan protocol (sent by uvicorn, not by daphne) so
+    # process wide resources are released cleanly on shutdown
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await run_shutdown_callbacks()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def install_reactor_shutdown():
+    # daphne never sends lifespan events. Under daphne (or any server on
+    # Twisted's asyncio reactor) the callbacks run from a shutdown trigger
+    # instead, while the event loop still runs, and the reactor waits for
+    # them on SIGTERM and SIGINT.
+    reactor = sys.modules.get('twisted.internet.reactor')
+    if reactor is None:
+        return False
+    from twisted.internet.defer import Deferred
+
+    reactor.addSystemEventTrigger(
+        'before', 'shutdown', lambda: Deferred.fromFuture(asyncio.ensure_future(run_shutdown_callbacks()))
+    )
+    return True
@@ -0,0 +1,55 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class Saturated(Exception):
+    pass
+
+
+class ConcurrencyLimiter:
+    # Caps concurrent work and the number of callers queued behind it.
+    # Callers beyond max_queue, or waiting longer than queue_timeout, are
+    # rejected at once so latency can't grow without bound.
+    def __init__(self, limit, max_queue, queue_timeout):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.rejected = 0
+
+    @property
+    def active(self):
+        return self.limit - self.semaphore._value
+
+    @asynccontextmanager
+    async def acquire(self):
+        if not self.semaphore.locked():
+            # A slot is free, this doesn't wait
+            await self.semaphore.acquire()
+        else:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise Saturated('Too many requests queued')
+
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise Saturated('Timed out waiting for a free slot')
+            finally:
+                self.waiting -= 1
+
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+        }
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import time
+import tracemalloc
+import msgpack
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from chat.persistence import get_message_writer
+from chat.protocol import FLAG_RAW
+from chat.routing import websocket_urlpatterns
+from chat.translate import get_translation_service
+
+LANGUAGES = ['en', 'fr', 'de', 'es', 'hi', 'ja', 'zh-cn', 'ar', 'ru', 'pt']
+
+
+class CountingBackend:
+    # Wraps the translation backend to count what actually reaches it
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+        self.texts = 0
+
+    async def translate(self, text, dest, src='auto'):
+        self.calls += 1
+        self.texts += 1
+        return await self.backend.translate(text, dest, src)
+
+    async def translate_many(self, texts, dest, src='auto'):
+        self.calls += 1
+        self.texts += len(texts)
+        return await self.backend.translate_many(texts, dest, src)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(percent / 100 * (len(values) - 1)))]
+
+
+class BenchClient:
+    def __init__(self, application, index, room, language, msgpack_frames=False):
+        self.index = index
+        self.room = room
+        self.msgpack_frames = msgpack_frames
+        path = f"/ws/chat/{room}/?lang={language}"
+        if msgpack_frames:
+            path += "&format=msgpack"
+        self.communicator = WebsocketCommunicator(application, path)
+        self.received = 0
+
+    async def send(self, message):
+        if self.msgpack_frames:
+            await self.communicator.send_to(bytes_data=bytes([FLAG_RAW]) + msgpack.packb({"message": message}))
+        else:
+            await self.communicator.send_to(text_data=json.dumps({"message": message}))
+
+    async def receive(self, expected, sent_at, latencies, deadline):
+        while self.received < expected:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                return
+            try:
+                frame = await self.communicator.receive_output(timeout)
+            except asyncio.TimeoutError:
+                return
+            now = time.perf_counter()
+            if frame.get("bytes") is not None:
+                envelopes = msgpack.unpackb(frame["bytes"][1:])
+            else:
+                envelopes = [json.loads(frame["text"])]
+            for envelope in envelopes:
+                # Deferred translations of a message already counted
+                if envelope.get("update"):
+                    continue
+                latencies.append(now - sent_at[envelope["original"]])
+                self.received += 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive simulated WebSocket clients across rooms and languages against ChatConsumer and report "
+        "throughput, end-to-end latency, translation calls per message and memory per connection. "
+        "Run with --settings=chat_project.settings_bench."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=100)
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--languages', type=int, default=5, help=f'At most {len(LANGUAGES)}')
+        parser.add_argument('--messages', type=int, default=10, help='Messages sent by every client')
+        parser.add_argument('--interval', type=float, default=0.05, help='Seconds between messages of a client')
+        parser.add_argument('--latency', type=float, default=None, help='Stub translator latency in seconds')
+        parser.add_argument('--format', choices=['json', 'msgpack'], default='json')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for every delivery')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        results = asyncio.run(self.run(**options))
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for name, value in results.items():
+            self.stdout.write(f"{name:>28}: {value:.4g}" if isinstance(value, float) else f"{name:>28}: {value}")
+
+    async def run(self, clients, rooms, languages, messages, interval, latency, format, timeout, **options):
+        service = get_translation_service()
+        backend = CountingBackend(service.backend)
+        primary = getattr(service.backend, 'primary', service.backend)
+        if latency is not None and hasattr(primary, 'latency'):
+            primary.latency = latency
+        service.backend = backend
+
+        application = URLRouter(websocket_urlpatterns)
+        languages = LANGUAGES[:max(1, languages)]
+        # Spread every language over every room
+        bench_clients = [
+            BenchClient(application, i, f"bench{i % rooms}", languages[(i // rooms) % len(languages)],
+                        format == 'msgpack')
+            for i in range(clients)
+        ]
+
+        # Memory held per connection, consumer and test transport included
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for client in bench_clients:
+            connected, _ = await client.communicator.connect()
+            if not connected:
+                raise RuntimeError(f"Client {client.index} could not connect")
+        memory = (tracemalloc.get_traced_memory()[0] - before) / clients
+        tracemalloc.stop()
+
+        room_sizes = {}
+        for client in bench_clients:
+            room_sizes[client.room] = room_sizes.get(client.room, 0) + 1
+
+        sent_at = {}
+        latencies = []
+
+        async def send_all(client):
+            for n in range(messages):
+                message = f"bench {client.index} {n}"
+                sent_at[message] = time.perf_counter()
+                await client.send(message)
+                await asyncio.sleep(interval)
+
+        start = time.perf_counter()
+        deadline = start + timeout
+        await asyncio.gather(
+            *(send_all(client) for client in bench_clients),
+            *(client.receive(room_sizes[client.room] * messages, sent_at, latencies, deadline)
+              for client in bench_clients),
+        )
+        elapsed = time.perf_counter() - start
+
+        for client in bench_clients:
+            await client.communicator.disconnect()
+        await get_message_writer().flush()
+        service.backend = backend.backend
+
+        sent = clients * messages
+        expected = sum(size * size * messages for size in room_sizes.values())
+        return {
+            'clients': clients,
+            'rooms': rooms,
+            'languages': len(languages),
+            'messages sent': sent,
+            'deliveries': len(latencies),
+            'missing deliveries': expected - len(latencies),
+            'elapsed (s)': elapsed,
+            'messages/s': sent / elapsed,
+            'deliveries/s': len(latencies) / elapsed,
+            'p50 latency (ms)': percentile(latencies, 50) * 1000,
+            'p99 latency (ms)': percentile(latencies, 99) * 1000,
+            'translation calls/message': backend.calls / sent,
+            'translated texts/message': backend.texts / sent,
+            'memory/connection (KiB)': memory / 1024,
+        }
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client
+from rest_framework_simplejwt.tokens import RefreshToken
+from chat.management.commands.bench_chat import percentile
+from chat.models import CustomUser
+from chat.otp import get_otp_store
+from chat.translate import get_translation_service, remove_diacritics, remove_diacritics_many
+
+BENCH_MOBILE = '+10000000000'
+DIACRITICS_SAMPLES = [
+    'Hello, how are you today?',
+    'Ça va très bien, merci beaucoup. À bientôt !',
+    'Nǐ hǎo, wǒ jiào Lǐ Míng. Hěn gāoxìng rènshi nǐ.',
+    'Tiếng Việt có rất nhiều dấu thanh và dấu phụ. ' * 20,
+]
+
+
+def timed(function, iterations, setup=None):
+    durations = []
+    for i in range(iterations):
+        arguments = setup(i) if setup else ()
+        start = time.perf_counter()
+        function(*arguments)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+async def atimed(function, iterations, setup=None):
+    durations = []
+    for i in range(iterations):
+        arguments = setup(i) if setup else ()
+        start = time.perf_counter()
+        await function(*arguments)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmarks of translate_text, remove_diacritics and the auth views. "
+        "Run with --settings=chat_project.settings_bench."
+    )
+
+    benchmarks = [
+        'remove_diacritics',
+        'remove_diacritics_many',
+        'translate_text_cached',
+        'translate_text_uncached',
+        'login',
+        'verify_otp',
+        'user',
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', nargs='*', help=f"Any of {', '.join(self.benchmarks)}, default all")
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--latency', type=float, default=0, help='Stub translator latency in seconds')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        names = options['benchmark'] or self.benchmarks
+        unknown = set(names) - set(self.benchmarks)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+        backend = get_translation_service().backend
+        backend = getattr(backend, 'primary', backend)
+        if hasattr(backend, 'latency'):
+            backend.latency = options['latency']
+        self.user = self.get_user()
+
+        results = {}
+        for name in names:
+            durations = getattr(self, f'bench_{name}')(options['iterations'])
+            total = sum(durations)
+            results[name] = {
+                'ops/s': len(durations) / total if total else 0.0,
+                'mean (us)': total / len(durations) * 1e6,
+                'p50 (us)': percentile(durations, 50) * 1e6,
+                'p99 (us)': percentile(durations, 99) * 1e6,
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'benchmark':<26}{'ops/s':>12}{'mean (us)':>12}{'p50 (us)':>12}{'p99 (us)':>12}")
+        for name, result in results.items():
+            self.stdout.write(f"{name:<26}" + ''.join(f"{value:>12.1f}" for value in result.values()))
+
+    def get_user(self):
+        user = CustomUser.objects.filter(mobile=BENCH_MOBILE).first()
+        if user is None:
+            user = CustomUser.objects.create_user(BENCH_MOBILE, username='bench')
+        if not user.is_active:
+            user.activate()
+        return user
+
+    def bench_remove_diacritics(self, iterations):
+        samples = DIACRITICS_SAMPLES
+        return timed(lambda: [remove_diacritics(text) for text in samples], iterations)
+
+    def bench_remove_diacritics_many(self, iterations):
+        samples = DIACRITICS_SAMPLES
+        return timed(lambda: remove_diacritics_many(samples), iterations)
+
+    def bench_translate_text_cached(self, iterations):
+        return asyncio.run(self.translate_text(iterations, lambda i: 'Hello, how are you today?'))
+
+    def bench_translate_text_uncached(self, iterations):
+        started = time.time()
+        return asyncio.run(self.translate_text(iterations, lambda i: f'Hello {started} {i}'))
+
+    async def translate_text(self, iterations, text):
+        client = AsyncClient()
+
+        async def post(input_text):
+            response = await client.post(
+                '/chat/translate/', json.dumps({'input_text': input_text, 'dest': 'fr'}),
+                content_type='application/json',
+            )
+            assert response.status_code == 200, response.content
+
+        return await atimed(post, iterations, lambda i: (text(i),))
+
+    def bench_login(self, iterations):
+        client = Client()
+
+        def post():
+            response = client.post('/chat/login/', {'mobile': BENCH_MOBILE}, content_type='application/json')
+            assert response.status_code == 200, response.content
+
+        return timed(post, iterations)
+
+    def bench_verify_otp(self, iterations):
+        client = Client()
+
+        def post(otp):
+            response = client.post(
+                '/chat/verify-otp/', {'mobile': BENCH_MOBILE, 'otp': otp}, content_type='application/json',
+            )
+            assert response.status_code == 200, response.content
+
+        # Issuing the OTP is not part of the measurement
+        return timed(post, iterations, lambda i: (get_otp_store().issue(BENCH_MOBILE),))
+
+    def bench_user(self, iterations):
+        token = str(RefreshToken.for_user(self.user).access_token)
+        client = Client(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+        def get():
+            response = client.get('/chat/user/')
+            assert response.status_code == 200, response.content
+
+        return timed(get, iterations)
@@ -0,0 +1,251 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+
+
+# Process-wide metrics in the Prometheus text exposition format. Updates are
+# a dict lookup and an addition under a per-metric lock, cheap enough for
+# the hot paths. Values are per process: scrape every worker.
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+_collectors = []
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.label_names) or 'none'}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        for key, value in sorted(items):
+            yield self.name, tuple(zip(self.label_names, key)), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per bucket counts, the last one for +Inf, then sum
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self.values.items()]
+        for key, state in sorted(items):
+            labels = tuple(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                yield f'{self.name}_bucket', labels + (('le', format_value(float(bound))),), cumulative
+            yield f'{self.name}_sum', labels, state[-1]
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Timer:
+    # Observes the elapsed time of a block, or of every call of a function
+    # or coroutine function when used as a decorator:
+    #
+    #     with TRANSLATION_LATENCY.time(language='fr'): ...
+    #     @timed(CHAT_RECEIVE_LATENCY)
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+    def __call__(self, function):
+        histogram, labels = self.histogram, self.labels
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+
+
+def timed(histogram, **labels):
+    return Timer(histogram, labels)
+
+
+def collector(function):
+    # Registers a function called on every scrape, returning
+    # (name, type, help, [(labels, value), ...]) tuples built from the
+    # stats() of components that already count for themselves
+    _collectors.append(function)
+    return function
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for function in _collectors:
+        try:
+            families = function()
+        except Exception as e:
+            lines.append(f'# Error collecting {function.__name__}: {escape(e)}')
+            continue
+        for name, kind, documentation, samples in families:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{format_labels(tuple(labels.items()))} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+# Queries run by the current request, counted through a database execute
+# wrapper installed on every connection
+_query_count = contextvars.ContextVar('query_count', default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    queries = _query_count.get()
+    if queries is not None:
+        queries[0] += 1
+    return execute(sql, params, many, context)
+
+
+def start_query_count():
+    queries = [0]
+    return queries, _query_count.set(queries)
+
+
+def stop_query_count(token):
+    _query_count.reset(token)
+
+
+TRANSLATION_LATENCY = Histogram(
+    'translation_latency_seconds', 'Translation backend call latency', ['language']
+)
+TRANSLATION_ERRORS = Counter(
+    'translation_errors_total', 'Failed translation backend calls', ['language']
+)
+TRANSLATION_SHORT_CIRCUITS = Counter(
+    'translation_short_circuits_total', 'Chat messages not translated into their own source language'
+)
+CHAT_FANOUT_LATENCY = Histogram(
+    'chat_fanout_seconds', 'Time from receiving a chat message to handing every translation to the room group'
+)
+CHAT_FANOUT_LANGUAGES = Histogram(
+    'chat_fanout_languages', 'Languages a chat message is translated into', buckets=(1, 2, 3, 5, 8, 13, 21)
+)
+CHAT_DEFERRED_TRANSLATIONS = Counter(
+    'chat_deferred_translations_total', 'Chat messages delivered before their translations were ready'
+)
+CHAT_RECEIVE_LATENCY = Histogram(
+    'chat_receive_seconds', 'Time ChatConsumer.receive spends on a message'
+)
+GROUP_SEND_LATENCY = Histogram(
+    'channel_layer_group_send_seconds', 'Channel layer group_send latency', ['consumer']
+)
+WEBSOCKET_CONNECTIONS = Gauge(
+    'websocket_connections', 'Open WebSocket connections', ['consumer']
+)
+OTP_SEND_LATENCY = Histogram(
+    'otp_send_seconds', 'OTP sender latency, per attempt'
+)
+HTTP_REQUEST_LATENCY = Histogram(
+    'http_request_seconds', 'HTTP request latency', ['view']
+)
+HTTP_DB_QUERIES = Histogram(
+    'http_db_queries', 'Database queries per HTTP request', ['view'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
@@ -0,0 +1,93 @@
+import time
+from urllib.parse import parse_qs
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from channels.auth import AuthMiddlewareStack
+from channels.middleware import BaseMiddleware
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from .metrics import start_query_count, stop_query_count, HTTP_DB_QUERIES, HTTP_REQUEST_LATENCY
+from .principals import aget_cached_user
+
+
+def get_scope_token(scope):
+    # Access token from ?token= or an "Authorization: Bearer" header
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if 'token' in query:
+        return query['token'][0]
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            parts = value.decode().split()
+            if len(parts) == 2 and parts[0] in api_settings.AUTH_HEADER_TYPES:
+                return parts[1]
+    return None
+
+
+async def get_token_user(raw_token):
+    try:
+        token = AccessToken(raw_token)
+        user_id = token[api_settings.USER_ID_CLAIM]
+    except (TokenError, KeyError):
+        return None
+    user = await aget_cached_user(user_id)
+    if user is None or not user.is_active:
+        return None
+    return user
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    # Authenticates WebSocket connections that carry a JWT access token,
+    # using the principal cache rather than a query per connect. Connections
+    # without a valid token keep the session user.
+    async def __call__(self, scope, receive, send):
+        raw_token = get_scope_token(scope)
+        if raw_token:
+            user = await get_token_user(raw_token)
+            if user is not None:
+                scope = dict(scope, user=user)
+        return await super().__call__(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    return AuthMiddlewareStack(JWTAuthMiddleware(inner))
+
+
+class RequestMetricsMiddleware:
+    # Records the latency and the number of database queries of every HTTP
+    # request, per view, for both sync and async views
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        queries, token = start_query_count()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            stop_query_count(token)
+        self.record(request, time.perf_counter() - start, queries[0])
+        return response
+
+    async def __acall__(self, request):
+        queries, token = start_query_count()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            stop_query_count(token)
+        self.record(request, time.perf_counter() - start, queries[0])
+        return response
+
+    def record(self, request, duration, queries):
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        HTTP_REQUEST_LATENCY.observe(duration, view=view)
+        HTTP_DB_QUERIES.observe(queries, view=view)
@@ -0,0 +1,17 @@
+# Generated by Django 5.0 on 2026-10-18 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatmessage_room_sender_language'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', '-timestamp', '-id'], name='chatmessage_room_history_idx'),
+        ),
+    ]
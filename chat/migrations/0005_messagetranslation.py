@@ -0,0 +1,28 @@
+# Generated by Django 5.0 on 2026-10-18 12:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatmessage_room_history_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTranslation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('language', models.CharField(max_length=10)),
+                ('text', models.TextField()),
+                ('pronunciation', models.TextField(blank=True, default='')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='translations', to='chat.chatmessage')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='messagetranslation',
+            constraint=models.UniqueConstraint(fields=('message', 'language'), name='unique_message_translation'),
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.0 on 2026-10-18 13:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def remove_duplicate_requests(apps, schema_editor):
+    # Keep one request per (sender, receiver) pair: the latest accepted one,
+    # so no friendship is lost, else the latest
+    ConnectionRequest = apps.get_model('chat', 'ConnectionRequest')
+    kept = {}
+    duplicates = []
+    requests = ConnectionRequest.objects.order_by('-id').only('id', 'sender_id', 'receiver_id', 'status')
+    for request in requests.iterator():
+        pair = (request.sender_id, request.receiver_id)
+        current = kept.get(pair)
+        if current is None:
+            kept[pair] = request
+        elif request.status == 'accepted' and current.status != 'accepted':
+            duplicates.append(current.id)
+            kept[pair] = request
+        else:
+            duplicates.append(request.id)
+    ConnectionRequest.objects.filter(id__in=duplicates).delete()
+
+
+def create_connections(apps, schema_editor):
+    ConnectionRequest = apps.get_model('chat', 'ConnectionRequest')
+    Connection = apps.get_model('chat', 'Connection')
+    connections = []
+    for sender_id, receiver_id in ConnectionRequest.objects.filter(status='accepted').values_list('sender_id', 'receiver_id').iterator():
+        connections.append(Connection(user_id=sender_id, friend_id=receiver_id))
+        connections.append(Connection(user_id=receiver_id, friend_id=sender_id))
+    Connection.objects.bulk_create(connections, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_messagetranslation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Connection',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='connectionrequest',
+            index=models.Index(fields=['receiver', 'status', '-id'], name='connrequest_receiver_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='connectionrequest',
+            index=models.Index(fields=['sender', 'status', '-id'], name='connrequest_sender_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_requests, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='connectionrequest',
+            constraint=models.UniqueConstraint(fields=('sender', 'receiver'), name='unique_connection_request'),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='friend',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='connections', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='connection',
+            constraint=models.UniqueConstraint(fields=('user', 'friend'), name='unique_connection'),
+        ),
+        migrations.RunPython(create_connections, migrations.RunPython.noop),
+    ]
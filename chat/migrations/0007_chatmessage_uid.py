@@ -0,0 +1,26 @@
+# Generated by Django 5.0 on 2026-10-18 13:06
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_connection_graph'),
+    ]
+
+    operations = [
+        # Existing messages keep a null uid rather than all sharing the one
+        # default evaluated by AddField
+        migrations.AddField(
+            model_name='chatmessage',
+            name='uid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='uid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, null=True),
+        ),
+    ]
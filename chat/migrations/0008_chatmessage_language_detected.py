@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatmessage_uid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='language_detected',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0 on 2026-10-18 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_chatmessage_language_detected'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(fields=['user', '-id'], name='connection_user_idx'),
+        ),
+    ]
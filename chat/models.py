@@ -1,19 +1,59 @@
 import os
+import uuid
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
-from django.utils import timezone, crypto
+from django.utils import timezone
+from .otp import generate_otp, get_otp_store
+from .principals import invalidate_user
 from .utils import send_otp, generate_qr_code
 
 class ChatMessage(models.Model):
+    room = models.CharField(max_length=100, default='')
+    sender = models.ForeignKey('CustomUser', related_name='messages', null=True, blank=True, on_delete=models.SET_NULL)
+    language = models.CharField(max_length=10, blank=True, default='')  # Original language of the content
+    # Whether the translator detected language, rather than it being assumed
+    # from the sender's preferred language. Only a detected language is
+    # passed to the translator as the source.
+    language_detected = models.BooleanField(default=False)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is received, not when the write-behind buffer
+    # flushes it
+    timestamp = models.DateTimeField(default=timezone.now)
+    # Id sent to WebSocket clients in the message envelope, known before the
+    # write-behind buffer assigns the primary key
+    uid = models.UUIDField(default=uuid.uuid4, null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Room history is read newest first, paginated on (timestamp, id)
+            models.Index(fields=['room', '-timestamp', '-id'], name='chatmessage_room_history_idx'),
+        ]
+
+    @property
+    def source(self):
+        # Source language to give the translator
+        return self.language if self.language_detected else 'auto'
 
     def __str__(self):
         return f'Message sent at {self.timestamp}'
 
+class MessageTranslation(models.Model):
+    message = models.ForeignKey(ChatMessage, related_name='translations', on_delete=models.CASCADE)
+    language = models.CharField(max_length=10)
+    text = models.TextField()
+    pronunciation = models.TextField(blank=True, default='')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'language'], name='unique_message_translation'),
+        ]
+
+    def __str__(self):
+        return f'{self.language} translation of message {self.message_id}'
+
 class CustomUserManager(BaseUserManager):
     def _generate_otp(self):
-        return crypto.get_random_string(length=4, allowed_chars='0123456789')
+        return generate_otp()
 
 
     def create_user(self, mobile, **extra_fields):
@@ -21,12 +61,9 @@ class CustomUserManager(BaseUserManager):
             raise ValueError('The Mobile number must be set')
         user = self.model(mobile=mobile, **extra_fields)
         user.set_unusable_password()  
-        user.otp = self._generate_otp()
-        user.otp_created = timezone.now()
         user.is_active = False # User is inactive till he verifies OTP
+        generate_qr_code(user)  # Only renders once the user has a username
         user.save(using=self._db)
-        generate_qr_code(user)
-        user.save(using=self._db)  # Save the user again with QR code
         return user
 
     def create_superuser(self, mobile, password=None, **extra_fields):
@@ -51,12 +88,10 @@ class CustomUserManager(BaseUserManager):
             user = self.get(mobile=mobile)
         except self.model.DoesNotExist:
             user = self.create_user(mobile)
-        user.otp = self._generate_otp()
-        user.otp_created = timezone.now()
-        user.save()
+        otp = get_otp_store().issue(mobile)
 
         # Logic to send OTP
-        send_otp(mobile, user.otp)
+        send_otp(mobile, otp)
         return user
 
 class CustomUser(AbstractBaseUser, PermissionsMixin):
@@ -89,16 +124,29 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     USERNAME_FIELD = 'mobile'
     REQUIRED_FIELDS = []
 
+    # Username as loaded from the database, so caches keyed by the old
+    # username can be invalidated when it changes
+    loaded_username = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.loaded_username = instance.__dict__.get('username')
+        return instance
 
     def verify_otp(self, otp):
-        # Logic to verify OTP and activate user
-        if self.otp == otp and self.otp_created + timezone.timedelta(minutes=5) > timezone.now():
-            self.is_active = True
-            self.otp = None  # Clear the OTP once verified
-            self.save()
+        # Logic to verify OTP and activate user. The store consumes the OTP.
+        if get_otp_store().verify(self.mobile, otp):
+            self.activate()
             return True
         return False
 
+    def activate(self):
+        if not self.is_active:
+            self.is_active = True
+            type(self).objects.filter(pk=self.pk).update(is_active=True)
+            invalidate_user(self.pk)
+
     def __str__(self):
         return self.mobile
 
@@ -109,5 +157,35 @@ class ConnectionRequest(models.Model):
     status = models.CharField(max_length=10, choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('rejected', 'Rejected')], default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'receiver'], name='unique_connection_request'),
+        ]
+        indexes = [
+            # Incoming and outgoing request lists, newest first
+            models.Index(fields=['receiver', 'status', '-id'], name='connrequest_receiver_idx'),
+            models.Index(fields=['sender', 'status', '-id'], name='connrequest_sender_idx'),
+        ]
+
     def __str__(self):
         return f'{self.sender} -> {self.receiver}: {self.status}'
+
+
+class Connection(models.Model):
+    # Accepted connections, denormalized with one row per direction so a
+    # user's connections are a single index range scan
+    user = models.ForeignKey(CustomUser, related_name='connections', on_delete=models.CASCADE)
+    friend = models.ForeignKey(CustomUser, related_name='+', on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'friend'], name='unique_connection'),
+        ]
+        indexes = [
+            # A user's connections, newest first
+            models.Index(fields=['user', '-id'], name='connection_user_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} <-> {self.friend}'
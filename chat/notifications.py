@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .metrics import GROUP_SEND_LATENCY
+
+logger = logging.getLogger(__name__)
+
+
+NOTIFICATION_BATCH_WINDOW = getattr(settings, 'NOTIFICATION_BATCH_WINDOW', 0.25)  # seconds
+NOTIFICATION_BATCH_SIZE = getattr(settings, 'NOTIFICATION_BATCH_SIZE', 50)
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
+
+
+def presence_room_name(user_id):
+    # Presence room holding the notification sockets a user has open
+    return f'notifications_{user_id}'
+
+
+def public_user(user):
+    return {'id': user.pk, 'username': user.username}
+
+
+def connection_request_event(event_type, request_id, user):
+    return {'type': event_type, 'request_id': request_id, 'user': public_user(user)}
+
+
+def presence_event(event_type, user_id):
+    return {'type': event_type, 'user_id': user_id}
+
+
+def coalesce_events(events):
+    # Only the latest event about the same request or the same friend's
+    # presence is worth delivering, e.g. online then offline is just offline
+    latest = {}
+    for event in events:
+        if 'request_id' in event:
+            key = ('request', event['request_id'])
+        elif 'user_id' in event:
+            key = ('presence', event['user_id'])
+        else:
+            key = ('event', id(event))
+        latest.pop(key, None)
+        latest[key] = event
+    return list(latest.values())
+
+
+async def apublish_many(items, channel_layer=None):
+    # items are (user_id, event) pairs
+    channel_layer = channel_layer or get_channel_layer()
+
+    async def send(user_id, event):
+        with GROUP_SEND_LATENCY.time(consumer="notifications"):
+            await channel_layer.group_send(user_group_name(user_id), {"type": "notification.event", "event": event})
+
+    await asyncio.gather(*(send(user_id, event) for user_id, event in items))
+
+
+def publish_many(items):
+    # Publishing must never fail the request that triggered it
+    if not items:
+        return
+    try:
+        async_to_sync(apublish_many)(items)
+    except Exception:
+        logger.exception("Error publishing notifications")
+
+
+def publish(user_id, event):
+    publish_many([(user_id, event)])
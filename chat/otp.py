@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils import crypto, timezone
+from django.utils.module_loading import import_string
+from redis.exceptions import RedisError
+from twilio.rest import Client
+from .lifespan import on_shutdown
+from .metrics import collector, OTP_SEND_LATENCY
+from .redis import get_redis_url, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+
+OTP_SENDER_BACKEND = getattr(settings, 'OTP_SENDER_BACKEND', 'chat.otp.TwilioOTPSender')
+OTP_SEND_WORKERS = getattr(settings, 'OTP_SEND_WORKERS', 4)
+OTP_SEND_RETRIES = getattr(settings, 'OTP_SEND_RETRIES', 3)
+OTP_SEND_BACKOFF = getattr(settings, 'OTP_SEND_BACKOFF', 0.5)  # seconds, doubled on every retry
+OTP_SEND_MAX_QUEUE = getattr(settings, 'OTP_SEND_MAX_QUEUE', 10000)
+OTP_EXPIRATION_TIME = getattr(settings, 'OTP_EXPIRATION_TIME', 5)  # minutes
+OTP_STORE = getattr(settings, 'OTP_STORE', None)
+OTP_MAX_ATTEMPTS = getattr(settings, 'OTP_MAX_ATTEMPTS', 5)  # per issued OTP
+OTP_ISSUE_LIMIT = getattr(settings, 'OTP_ISSUE_LIMIT', 5)  # per mobile and window
+OTP_ISSUE_WINDOW = getattr(settings, 'OTP_ISSUE_WINDOW', 3600)  # seconds
+
+
+class OTPRateLimited(Exception):
+    pass
+
+
+class OTPQueueFull(Exception):
+    pass
+
+
+def generate_otp():
+    return crypto.get_random_string(length=4, allowed_chars='0123456789')
+
+
+class DatabaseOTPStore:
+    # Keeps the OTP on the user row, touching only the OTP columns. Rate
+    # limit counters live in the given cache, the Django cache by default.
+    def __init__(self, cache=cache):
+        self.cache = cache
+
+    def issue(self, mobile):
+        check_rate_limit(self.cache, f'otp:issued:{mobile}', OTP_ISSUE_LIMIT, OTP_ISSUE_WINDOW,
+                         'Too many OTPs requested, please try again later')
+        otp = generate_otp()
+        get_user_model().objects.filter(mobile=mobile).update(otp=otp, otp_created=timezone.now())
+        self.cache.delete(f'otp:attempts:{mobile}')
+        return otp
+
+    def verify(self, mobile, otp):
+        check_rate_limit(self.cache, f'otp:attempts:{mobile}', OTP_MAX_ATTEMPTS, OTP_EXPIRATION_TIME * 60,
+                         'Too many attempts, please try again later')
+        # Verify and consume in one conditional UPDATE
+        cutoff = timezone.now() - timedelta(minutes=OTP_EXPIRATION_TIME)
+        consumed = get_user_model().objects.filter(
+            mobile=mobile, otp=otp, otp_created__gt=cutoff
+        ).update(otp=None)
+        if consumed:
+            self.cache.delete(f'otp:attempts:{mobile}')
+        return bool(consumed)
+
+
+def check_rate_limit(cache, key, limit, window, error):
+    cache.add(key, 0, window)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Expired between add and incr
+        cache.set(key, 1, window)
+        count = 1
+    if count > limit:
+        raise OTPRateLimited(error)
+
+
+# Compares and deletes the OTP atomically, so each OTP is accepted at most
+# once, and counts attempts against it
+VERIFY_SCRIPT = """
+local attempts = redis.call('INCR', KEYS[2])
+if attempts == 1 then
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+if attempts > tonumber(ARGV[2]) then
+    return -1
+end
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return 1
+end
+return 0
+"""
+
+
+class RedisOTPStore:
+    # OTPs expire natively after OTP_EXPIRATION_TIME and never touch the
+    # users table. Falls back to the database if Redis is unreachable. The
+    # Django cache is on the same Redis, so the fallback keeps its rate
+    # limit counters in process memory: limits are per worker while Redis
+    # is down, but still enforced.
+    def __init__(self):
+        self.fallback = DatabaseOTPStore(LocMemCache('otp-fallback', {}))
+
+    def issue(self, mobile):
+        redis = get_sync_redis()
+        try:
+            pipe = redis.pipeline()
+            pipe.set(f'otp:issued:{mobile}', 0, ex=OTP_ISSUE_WINDOW, nx=True)
+            pipe.incr(f'otp:issued:{mobile}')
+            _, issued = pipe.execute()
+            if issued > OTP_ISSUE_LIMIT:
+                raise OTPRateLimited('Too many OTPs requested, please try again later')
+
+            otp = generate_otp()
+            pipe = redis.pipeline()
+            pipe.set(f'otp:{mobile}', otp, ex=OTP_EXPIRATION_TIME * 60)
+            pipe.delete(f'otp:attempts:{mobile}')
+            pipe.execute()
+            return otp
+        except (RedisError, OSError) as e:
+            logger.warning("Error issuing OTP through Redis: %s", e)
+            return self.fallback.issue(mobile)
+
+    def verify(self, mobile, otp):
+        redis = get_sync_redis()
+        try:
+            result = redis.eval(
+                VERIFY_SCRIPT, 2, f'otp:{mobile}', f'otp:attempts:{mobile}',
+                otp, OTP_MAX_ATTEMPTS, OTP_EXPIRATION_TIME * 60,
+            )
+        except (RedisError, OSError) as e:
+            logger.warning("Error verifying OTP through Redis: %s", e)
+            return self.fallback.verify(mobile, otp)
+        if result == -1:
+            raise OTPRateLimited('Too many attempts, please try again later')
+        return result == 1
+
+
+_store = None
+
+
+def get_otp_store():
+    global _store
+    if _store is None:
+        if OTP_STORE:
+            _store = import_string(OTP_STORE)()
+        elif get_redis_url():
+            _store = RedisOTPStore()
+        else:
+            _store = DatabaseOTPStore()
+    return _store
+
+
+class TwilioOTPSender:
+    def __init__(self):
+        # One client for the life of the process so its HTTP connections
+        # are reused between messages
+        if not settings.TWILIO_ACCOUNT_SID or not settings.TWILIO_AUTH_TOKEN:
+            raise ImproperlyConfigured('Set TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN to send OTPs')
+        self.client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        self.from_number = settings.TWILIO_FROM_NUMBER
+
+    def send(self, mobile, otp):
+        message = self.client.messages.create(
+            body=f'Your OTP for Babel-on is: {otp}',
+            from_=self.from_number,
+            to=mobile
+        )
+        return message.sid
+
+
+class FakeOTPSender:
+    # Keeps OTPs in memory instead of sending them, for tests and benchmarks
+    def __init__(self):
+        self.outbox = []
+
+    def send(self, mobile, otp):
+        self.outbox.append((mobile, otp))
+        return f'fake-{len(self.outbox)}'
+
+
+class OTPDispatcher:
+    # Sends OTPs from background threads so requests don't wait on the SMS
+    # provider. Failed sends are retried with exponential backoff.
+    def __init__(self, sender, workers=OTP_SEND_WORKERS, retries=OTP_SEND_RETRIES,
+                 backoff=OTP_SEND_BACKOFF, max_queue=OTP_SEND_MAX_QUEUE):
+        self.sender = sender
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.threads = []
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def dispatch(self, mobile, otp):
+        self.start()
+        try:
+            self.queue.put_nowait((mobile, otp))
+        except queue.Full:
+            # The SMS provider is falling behind, tell the caller to retry
+            # instead of sending from the request thread
+            raise OTPQueueFull('Too many OTPs waiting to be sent, please try again later')
+
+    def start(self):
+        if self.threads:
+            return
+        with self._lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'otp-sender-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.send(*item)
+            finally:
+                self.queue.task_done()
+
+    def send(self, mobile, otp):
+        for attempt in range(self.retries + 1):
+            try:
+                with OTP_SEND_LATENCY.time():
+                    sid = self.sender.send(mobile, otp)
+                self.sent += 1
+                return sid
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error("Error sending OTP to %s: %s", mobile, e)
+                    self.failed += 1
+                    return None
+                self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def close(self, timeout=10):
+        # Let the workers finish what is queued, then stop them
+        threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+        }
+
+
+_dispatcher = None
+
+
+def get_otp_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = OTPDispatcher(import_string(OTP_SENDER_BACKEND)())
+    return _dispatcher
+
+
+@on_shutdown
+async def close_otp_dispatcher():
+    if _dispatcher is not None:
+        await asyncio.to_thread(_dispatcher.close)
+
+
+@collector
+def otp_dispatcher_metrics():
+    if _dispatcher is None:
+        return []
+    stats = _dispatcher.stats()
+    return [
+        ('otp_send_queue_depth', 'gauge', 'OTPs waiting for a sender thread', [({}, stats['queue_depth'])]),
+        ('otp_sent_total', 'counter', 'OTPs sent', [({}, stats['sent'])]),
+        ('otp_send_failures_total', 'counter', 'OTPs given up on after every retry', [({}, stats['failed'])]),
+        ('otp_send_retries_total', 'counter', 'Retried OTP sends', [({}, stats['retried'])]),
+    ]
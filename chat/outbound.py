@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import weakref
+from collections import Counter, deque
+from django.conf import settings
+from .metrics import collector
+
+logger = logging.getLogger(__name__)
+
+
+# What to do with a new message when a client's outbound queue is full:
+# drop the oldest queued message, disconnect the client, or drop the oldest
+# and stop translating for the client until its queue drains
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+DEGRADE = 'degrade'
+
+OUTBOUND_MAX_QUEUE = getattr(settings, 'OUTBOUND_MAX_QUEUE', 256)
+OUTBOUND_BATCH_WINDOW = getattr(settings, 'OUTBOUND_BATCH_WINDOW', 0.02)  # seconds
+OUTBOUND_BATCH_SIZE = getattr(settings, 'OUTBOUND_BATCH_SIZE', 50)
+OUTBOUND_OVERFLOW_POLICY = getattr(settings, 'OUTBOUND_OVERFLOW_POLICY', DROP_OLDEST)
+# Close code sent to clients disconnected by the disconnect policy
+OUTBOUND_CLOSE_CODE = 4008
+
+# Every live queue of this worker, and what happened to the closed ones
+_queues = weakref.WeakSet()
+_totals = Counter()
+
+
+class OutboundQueue:
+    # Bounded per-connection queue between the channel layer and a client's
+    # WebSocket. Messages are sent from a single task, coalesced into frames
+    # of up to batch_size envelopes collected over batch_window seconds, so
+    # a slow client only ever holds max_size messages in memory.
+    def __init__(self, consumer, max_size=OUTBOUND_MAX_QUEUE, batch_window=OUTBOUND_BATCH_WINDOW,
+                 batch_size=OUTBOUND_BATCH_SIZE, policy=OUTBOUND_OVERFLOW_POLICY):
+        if policy not in (DROP_OLDEST, DISCONNECT, DEGRADE):
+            raise ValueError(f"Unknown outbound overflow policy {policy!r}")
+        self.consumer = consumer
+        self.max_size = max_size
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.policy = policy
+        self.queue = deque()
+        self.degraded = False
+        self.closed = False
+        self._sender = None
+        self.sent = 0
+        self.dropped = 0
+        _queues.add(self)
+
+    def put(self, envelope):
+        if self.closed:
+            return
+        if len(self.queue) >= self.max_size:
+            if self.policy == DISCONNECT:
+                _totals['disconnected'] += 1
+                self.close()
+                asyncio.get_running_loop().create_task(self.consumer.close(code=OUTBOUND_CLOSE_CODE))
+                return
+            self.queue.popleft()
+            self.dropped += 1
+            _totals['dropped'] += 1
+            if self.policy == DEGRADE and not self.degraded:
+                self.degraded = True
+                _totals['degraded'] += 1
+        self.queue.append(envelope)
+
+        if self._sender is None:
+            self._sender = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        try:
+            while self.queue:
+                # Give a burst a moment to pile up into a single frame
+                if len(self.queue) < self.batch_size and self.batch_window:
+                    await asyncio.sleep(self.batch_window)
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                await self.consumer.send_envelopes(batch)
+                self.sent += len(batch)
+                _totals['sent'] += len(batch)
+
+                # Translate for the client again once it caught up
+                if self.degraded and len(self.queue) <= self.max_size // 2:
+                    self.degraded = False
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Error sending to %s: %s", self.consumer.channel_name, e)
+        finally:
+            self._sender = None
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        if self._sender is not None:
+            self._sender.cancel()
+        _queues.discard(self)
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.queue),
+            'degraded': self.degraded,
+            'sent': self.sent,
+            'dropped': self.dropped,
+        }
+
+
+def outbound_stats():
+    # Outbound queues of this worker
+    queues = list(_queues)
+    depths = [len(queue.queue) for queue in queues]
+    return {
+        'connections': len(queues),
+        'queue_depth': sum(depths),
+        'max_queue_depth': max(depths, default=0),
+        'degraded_connections': sum(1 for queue in queues if queue.degraded),
+        'sent': _totals['sent'],
+        'dropped': _totals['dropped'],
+        'disconnected': _totals['disconnected'],
+        'degraded': _totals['degraded'],
+    }
+
+
+@collector
+def outbound_metrics():
+    stats = outbound_stats()
+    return [
+        ('websocket_outbound_queue_depth', 'gauge', 'Messages waiting in outbound queues', [
+            ({}, stats['queue_depth']),
+        ]),
+        ('websocket_outbound_queue_max_depth', 'gauge', 'Deepest outbound queue', [({}, stats['max_queue_depth'])]),
+        ('websocket_degraded_connections', 'gauge', 'Connections receiving untranslated messages', [
+            ({}, stats['degraded_connections']),
+        ]),
+        ('websocket_outbound_messages_total', 'counter', 'Outbound messages by outcome', [
+            ({'outcome': 'sent'}, stats['sent']),
+            ({'outcome': 'dropped'}, stats['dropped']),
+        ]),
+        ('websocket_overflow_disconnects_total', 'counter', 'Connections closed for a full outbound queue', [
+            ({}, stats['disconnected']),
+        ]),
+    ]
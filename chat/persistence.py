@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from collections import deque
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from .lifespan import on_shutdown
+from .metrics import collector
+from .models import ChatMessage, MessageTranslation
+
+logger = logging.getLogger(__name__)
+
+
+MESSAGE_WRITE_BATCH_SIZE = getattr(settings, 'MESSAGE_WRITE_BATCH_SIZE', 100)
+MESSAGE_WRITE_INTERVAL = getattr(settings, 'MESSAGE_WRITE_INTERVAL', 0.5)  # seconds
+MESSAGE_WRITE_MAX_QUEUE = getattr(settings, 'MESSAGE_WRITE_MAX_QUEUE', 10000)
+MESSAGE_WRITE_RETRIES = getattr(settings, 'MESSAGE_WRITE_RETRIES', 3)
+MESSAGE_WRITE_RETRY_DELAY = getattr(settings, 'MESSAGE_WRITE_RETRY_DELAY', 0.5)  # seconds, doubled per retry
+
+
+class MessageWriter:
+    # Write-behind buffer for chat messages and their translations. write()
+    # only appends to memory, the buffer is flushed with one bulk_create once
+    # it holds batch_size messages or flush_interval seconds after the first
+    # queued message. A batch that fails to save goes back to the front of
+    # the buffer and is retried with backoff before it is given up.
+    def __init__(self, batch_size=MESSAGE_WRITE_BATCH_SIZE, flush_interval=MESSAGE_WRITE_INTERVAL,
+                 max_queue=MESSAGE_WRITE_MAX_QUEUE, retries=MESSAGE_WRITE_RETRIES,
+                 retry_delay=MESSAGE_WRITE_RETRY_DELAY):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.buffer = deque()
+        self._timer = None
+        self._flush_task = None
+        self._flush_lock = None
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.flushes = 0
+
+    def write(self, message, translations=()):
+        if len(self.buffer) >= self.max_queue:
+            # The database is falling behind, shed the oldest message
+            self.buffer.popleft()
+            self.dropped += 1
+        self.buffer.append((message, list(translations)))
+
+        if len(self.buffer) >= self.batch_size:
+            self.schedule_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self.schedule_flush)
+
+    def schedule_flush(self):
+        # At most one flush task at a time, a running flush drains whatever
+        # is written meanwhile
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+            self._flush_task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error flushing chat messages", exc_info=task.exception())
+
+    async def flush(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            attempt = 0
+            while self.buffer:
+                batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+                try:
+                    await self.save(batch)
+                except Exception as e:
+                    if attempt < self.retries:
+                        logger.warning("Error saving %d chat messages, retrying: %s", len(batch), e)
+                        self.buffer.extendleft(reversed(batch))
+                        self.retried += 1
+                        await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                        attempt += 1
+                        continue
+                    logger.exception("Error saving %d chat messages", len(batch))
+                    self.failed += len(batch)
+                else:
+                    self.written += len(batch)
+                attempt = 0
+                self.flushes += 1
+
+    @database_sync_to_async
+    @transaction.atomic
+    def save(self, batch):
+        # Atomic, so a batch that is retried can't be saved twice
+        messages = ChatMessage.objects.bulk_create([message for message, _ in batch])
+
+        # Link the translations once the messages have primary keys
+        translations = []
+        for message, message_translations in zip(messages, (t for _, t in batch)):
+            if message.pk is None:
+                continue
+            for translation in message_translations:
+                translation.message = message
+                translations.append(translation)
+        MessageTranslation.objects.bulk_create(translations, ignore_conflicts=True)
+
+    async def close(self):
+        # Drain whatever is still buffered
+        await self.flush()
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.buffer),
+            'written': self.written,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'retried': self.retried,
+            'flushes': self.flushes,
+        }
+
+
+_writer = None
+
+
+def get_message_writer():
+    global _writer
+    if _writer is None:
+        _writer = MessageWriter()
+    return _writer
+
+
+@on_shutdown
+async def close_message_writer():
+    if _writer is not None:
+        await _writer.close()
+
+
+@collector
+def message_writer_metrics():
+    if _writer is None:
+        return []
+    stats = _writer.stats()
+    return [
+        ('chat_message_write_queue_depth', 'gauge', 'Chat messages waiting to be saved', [({}, stats['queue_depth'])]),
+        ('chat_messages_saved_total', 'counter', 'Chat messages by write outcome', [
+            ({'outcome': 'written'}, stats['written']),
+            ({'outcome': 'failed'}, stats['failed']),
+            ({'outcome': 'dropped'}, stats['dropped']),
+        ]),
+        ('chat_message_flushes_total', 'counter', 'Write-behind buffer flushes', [({}, stats['flushes'])]),
+        ('chat_message_write_retries_total', 'counter', 'Chat message batches retried after a failed save', [
+            ({}, stats['retried']),
+        ]),
+    ]
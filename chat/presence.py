@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import time
+from django.conf import settings
+from django.utils.module_loading import import_string
+from redis.exceptions import RedisError
+from .lifespan import on_shutdown
+from .redis import get_redis, get_redis_url
+
+logger = logging.getLogger(__name__)
+
+
+PRESENCE_STORE = getattr(settings, 'PRESENCE_STORE', None)
+PRESENCE_TTL = getattr(settings, 'PRESENCE_TTL', 90)  # seconds
+PRESENCE_HEARTBEAT_INTERVAL = getattr(settings, 'PRESENCE_HEARTBEAT_INTERVAL', 30)  # seconds
+
+
+class InMemoryPresenceStore:
+    # Single process store, for development and the in-memory channel layer
+    def __init__(self):
+        self.members = {}  # room -> {member: (language, last_seen)}
+        self.language_counts = {}  # room -> {language: number of members}
+
+    async def join(self, room, member, language, now, ttl):
+        members = self.members.setdefault(room, {})
+        counts = self.language_counts.setdefault(room, {})
+        old = members.get(member)
+        if old is None or old[0] != language:
+            if old is not None:
+                self._decrement(counts, old[0])
+            counts[language] = counts.get(language, 0) + 1
+        members[member] = (language, now)
+
+    async def join_many(self, entries, now, ttl):
+        for room, member, language in entries:
+            await self.join(room, member, language, now, ttl)
+
+    async def leave(self, room, member):
+        members = self.members.get(room, {})
+        old = members.pop(member, None)
+        if old is not None:
+            self._decrement(self.language_counts.get(room, {}), old[0])
+        if not members:
+            self.members.pop(room, None)
+            self.language_counts.pop(room, None)
+
+    async def prune(self, room, cutoff):
+        expired = [member for member, (_, last_seen) in self.members.get(room, {}).items() if last_seen < cutoff]
+        for member in expired:
+            await self.leave(room, member)
+        return len(expired)
+
+    async def languages(self, room):
+        return set(self.language_counts.get(room, {}))
+
+    async def member_count(self, room):
+        return len(self.members.get(room, {}))
+
+    async def occupied(self, rooms):
+        return {room for room in rooms if self.members.get(room)}
+
+    def _decrement(self, counts, language):
+        counts[language] = counts.get(language, 0) - 1
+        if counts[language] <= 0:
+            counts.pop(language, None)
+
+
+# Every member of a room is kept in three keys: a sorted set of members
+# scored by their last heartbeat, a hash of member -> language and a hash of
+# language -> number of members. The last one makes "distinct languages in
+# room" a single HKEYS on a hash with one field per language.
+JOIN_SCRIPT = """
+local old = redis.call('HGET', KEYS[2], ARGV[1])
+if old ~= ARGV[2] then
+    if old then
+        if redis.call('HINCRBY', KEYS[3], old, -1) <= 0 then
+            redis.call('HDEL', KEYS[3], old)
+        end
+    end
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('HINCRBY', KEYS[3], ARGV[2], 1)
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[4])
+end
+return 1
+"""
+
+LEAVE_SCRIPT = """
+local removed = 0
+for i = 1, #ARGV do
+    local old = redis.call('HGET', KEYS[2], ARGV[i])
+    redis.call('ZREM', KEYS[1], ARGV[i])
+    if old then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        if redis.call('HINCRBY', KEYS[3], old, -1) <= 0 then
+            redis.call('HDEL', KEYS[3], old)
+        end
+        removed = removed + 1
+    end
+end
+return removed
+"""
+
+
+class RedisPresenceStore:
+    # Shared by every worker, so a room's languages and members are visible
+    # cluster wide
+    def __init__(self, prefix='presence'):
+        self.prefix = prefix
+
+    def keys(self, room):
+        return [
+            f'{self.prefix}:{room}:members',
+            f'{self.prefix}:{room}:member_languages',
+            f'{self.prefix}:{room}:languages',
+        ]
+
+    async def join(self, room, member, language, now, ttl):
+        redis = get_redis()
+        await redis.eval(JOIN_SCRIPT, 3, *self.keys(room), member, language, now, ttl)
+
+    async def join_many(self, entries, now, ttl):
+        redis = get_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            for room, member, language in entries:
+                pipe.eval(JOIN_SCRIPT, 3, *self.keys(room), member, language, now, ttl)
+            await pipe.execute()
+
+    async def leave(self, room, member):
+        redis = get_redis()
+        await redis.eval(LEAVE_SCRIPT, 3, *self.keys(room), member)
+
+    async def prune(self, room, cutoff):
+        redis = get_redis()
+        expired = await redis.zrangebyscore(self.keys(room)[0], '-inf', cutoff)
+        if not expired:
+            return 0
+        return await redis.eval(LEAVE_SCRIPT, 3, *self.keys(room), *expired)
+
+    async def languages(self, room):
+        redis = get_redis()
+        return set(await redis.hkeys(self.keys(room)[2]))
+
+    async def member_count(self, room):
+        redis = get_redis()
+        return await redis.zcard(self.keys(room)[0])
+
+    async def occupied(self, rooms):
+        # One round trip however many rooms are asked about
+        rooms = list(rooms)
+        redis = get_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            for room in rooms:
+                pipe.exists(self.keys(room)[0])
+            found = await pipe.execute()
+        return {room for room, exists in zip(rooms, found) if exists}
+
+
+class PresenceRegistry:
+    # Tracks the members of each room and their preferred languages. Members
+    # joined from this process are refreshed by one heartbeat task, and
+    # entries left behind by crashed workers expire after PRESENCE_TTL.
+    def __init__(self, store, ttl=PRESENCE_TTL, heartbeat_interval=PRESENCE_HEARTBEAT_INTERVAL):
+        self.store = store
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.local_members = {}  # (room, member) -> language
+        self._heartbeat_task = None
+
+    async def join(self, room, member, language):
+        self.local_members[(room, member)] = language
+        try:
+            await self.store.join(room, member, language, time.time(), self.ttl)
+        except (RedisError, OSError) as e:
+            logger.warning("Error joining presence for %s: %s", room, e)
+        self.ensure_heartbeat()
+
+    async def leave(self, room, member):
+        self.local_members.pop((room, member), None)
+        try:
+            await self.store.leave(room, member)
+        except (RedisError, OSError) as e:
+            logger.warning("Error leaving presence for %s: %s", room, e)
+
+    async def languages(self, room):
+        try:
+            return await self.store.languages(room)
+        except (RedisError, OSError) as e:
+            logger.warning("Error reading presence for %s: %s", room, e)
+            return set()
+
+    async def member_count(self, room):
+        try:
+            return await self.store.member_count(room)
+        except (RedisError, OSError) as e:
+            logger.warning("Error reading presence for %s: %s", room, e)
+            return 0
+
+    async def occupied(self, rooms):
+        # The rooms with at least one member
+        try:
+            return await self.store.occupied(rooms)
+        except (RedisError, OSError) as e:
+            logger.warning("Error reading presence for %d rooms: %s", len(rooms), e)
+            return set()
+
+    async def heartbeat(self):
+        now = time.time()
+        entries = [(room, member, language) for (room, member), language in self.local_members.items()]
+        if entries:
+            await self.store.join_many(entries, now, self.ttl)
+        for room in {room for room, _, _ in entries}:
+            await self.store.prune(room, now - self.ttl)
+
+    def ensure_heartbeat(self):
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        while self.local_members:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except (RedisError, OSError) as e:
+                logger.warning("Error sending presence heartbeat: %s", e)
+
+    async def close(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        for room, member in list(self.local_members):
+            await self.leave(room, member)
+
+
+_registry = None
+
+
+def get_presence_registry():
+    global _registry
+    if _registry is None:
+        if PRESENCE_STORE:
+            store = import_string(PRESENCE_STORE)()
+        elif get_redis_url():
+            store = RedisPresenceStore()
+        else:
+            store = InMemoryPresenceStore()
+        _registry = PresenceRegistry(store)
+    return _registry
+
+
+@on_shutdown
+async def close_presence_registry():
+    if _registry is not None:
+        await _registry.close()
@@ -0,0 +1,58 @@
+import logging
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+
+USER_CACHE_TTL = getattr(settings, 'USER_CACHE_TTL', 60)  # seconds
+
+
+def user_cache_key(user_id):
+    return f'user:{user_id}'
+
+
+def get_cached_user(user_id):
+    # Authenticated principal by id, loaded from the database at most once
+    # per USER_CACHE_TTL. Fails open: without the cache every lookup is a
+    # query.
+    key = user_cache_key(user_id)
+    try:
+        user = cache.get(key)
+    except (RedisError, OSError) as e:
+        logger.warning("Error reading cached user %s: %s", user_id, e)
+        return get_user_model().objects.filter(pk=user_id).first()
+    if user is None:
+        user = get_user_model().objects.filter(pk=user_id).first()
+        if user is not None:
+            try:
+                cache.set(key, user, USER_CACHE_TTL)
+            except (RedisError, OSError) as e:
+                logger.warning("Error caching user %s: %s", user_id, e)
+    return user
+
+
+async def aget_cached_user(user_id):
+    key = user_cache_key(user_id)
+    try:
+        user = await cache.aget(key)
+    except (RedisError, OSError) as e:
+        logger.warning("Error reading cached user %s: %s", user_id, e)
+        return await get_user_model().objects.filter(pk=user_id).afirst()
+    if user is None:
+        user = await get_user_model().objects.filter(pk=user_id).afirst()
+        if user is not None:
+            try:
+                await cache.aset(key, user, USER_CACHE_TTL)
+            except (RedisError, OSError) as e:
+                logger.warning("Error caching user %s: %s", user_id, e)
+    return user
+
+
+def invalidate_user(user_id):
+    try:
+        cache.delete(user_cache_key(user_id))
+    except (RedisError, OSError) as e:
+        logger.warning("Error invalidating cached user %s: %s", user_id, e)
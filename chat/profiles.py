@@ -0,0 +1,70 @@
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from redis.exceptions import RedisError
+from .models import CustomUser
+from .serializers import PublicUserSerializer
+from .utils import generate_qr_code
+
+logger = logging.getLogger(__name__)
+
+
+PUBLIC_PROFILE_CACHE_TTL = getattr(settings, 'PUBLIC_PROFILE_CACHE_TTL', 3600)  # seconds
+MEDIA_CDN_URL = getattr(settings, 'MEDIA_CDN_URL', None)
+
+
+def get_media_url(name, request=None):
+    # Stable, unsigned URL of a stored file. QR code objects are content
+    # addressed, so the URL never goes stale for the same name.
+    if MEDIA_CDN_URL:
+        return f"{MEDIA_CDN_URL.rstrip('/')}/{name}"
+    url = default_storage.url(name)
+    if request is not None:
+        url = request.build_absolute_uri(url)
+    # Clean the url to get the only image
+    return url.split('?')[0]
+
+
+def public_profile_key(username):
+    return f'public-profile:{username}'
+
+
+def get_public_profile(username, request=None):
+    # Serialized public profile, cached by username so hot lookups (QR code
+    # scans) cost neither a query nor a storage call. Fails open: without the
+    # cache every lookup is a query.
+    key = public_profile_key(username)
+    try:
+        data = cache.get(key)
+    except (RedisError, OSError) as e:
+        logger.warning("Error reading cached public profile %s: %s", username, e)
+        data = None
+    if data is not None:
+        return data
+
+    user = CustomUser.objects.filter(username=username).only('id', 'username', 'qr_code').first()
+    if user is None:
+        return None
+    if not user.qr_code:
+        # Generate the QR code the first time it is requested
+        generate_qr_code(user)
+        user.save(update_fields=['qr_code'])
+
+    data = dict(PublicUserSerializer(user).data)
+    data['qr_code_url'] = get_media_url(user.qr_code.name, request)
+    try:
+        cache.set(key, data, PUBLIC_PROFILE_CACHE_TTL)
+    except (RedisError, OSError) as e:
+        logger.warning("Error caching public profile %s: %s", username, e)
+    return data
+
+
+def invalidate_public_profile(*usernames):
+    keys = [public_profile_key(username) for username in usernames if username]
+    if not keys:
+        return
+    try:
+        cache.delete_many(keys)
+    except (RedisError, OSError) as e:
+        logger.warning("Error invalidating cached public profiles %s: %s", usernames, e)
@@ -0,0 +1,102 @@
+import json
+import zlib
+import msgpack
+from django.conf import settings
+
+# WebSocket clients speak JSON text frames unless they opt into the binary
+# protocol, by offering MSGPACK_SUBPROTOCOL (or MSGPACK_ZLIB_SUBPROTOCOL) or
+# connecting with ?format=msgpack (and &compress=zlib)
+MSGPACK_SUBPROTOCOL = 'babel.msgpack'
+MSGPACK_ZLIB_SUBPROTOCOL = 'babel.msgpack+zlib'
+
+# Binary frames start with one flag byte telling whether the msgpack payload
+# that follows is zlib compressed. Only payloads of at least
+# WEBSOCKET_COMPRESSION_MIN_SIZE bytes are compressed, smaller ones don't shrink
+FLAG_RAW = 0
+FLAG_ZLIB = 1
+WEBSOCKET_COMPRESSION_MIN_SIZE = getattr(settings, 'WEBSOCKET_COMPRESSION_MIN_SIZE', 512)  # bytes
+WEBSOCKET_COMPRESSION_LEVEL = getattr(settings, 'WEBSOCKET_COMPRESSION_LEVEL', 6)
+WEBSOCKET_MAX_FRAME_SIZE = getattr(settings, 'WEBSOCKET_MAX_FRAME_SIZE', 1024 * 1024)  # bytes, decompressed
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class JSONCodec:
+    name = 'json'
+    subprotocol = None
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            return json.loads(text_data if text_data is not None else bytes_data)
+        except ValueError as e:
+            raise ProtocolError(f"Invalid JSON frame: {e}")
+
+    def encode(self, envelopes):
+        # One text frame per envelope, the shape existing clients expect
+        return [{"text_data": json.dumps(envelope)} for envelope in envelopes]
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    def __init__(self, compress=False, subprotocol=None):
+        self.compress = compress
+        self.subprotocol = subprotocol
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # Binary clients may still send text frames
+            return JSONCodec().decode(text_data)
+        if not bytes_data:
+            raise ProtocolError("Empty binary frame")
+
+        flag, payload = bytes_data[0], bytes_data[1:]
+        try:
+            if flag == FLAG_ZLIB:
+                decompressor = zlib.decompressobj()
+                payload = decompressor.decompress(payload, WEBSOCKET_MAX_FRAME_SIZE)
+                if decompressor.unconsumed_tail:
+                    raise ProtocolError("Binary frame too large")
+            elif flag != FLAG_RAW:
+                raise ProtocolError(f"Unknown frame flag {flag}")
+            return msgpack.unpackb(payload, raw=False)
+        except (zlib.error, ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as e:
+            raise ProtocolError(f"Invalid binary frame: {e}")
+
+    def encode(self, envelopes):
+        # Every envelope ready at the same time goes out in a single frame,
+        # as a msgpack array
+        payload = msgpack.packb(list(envelopes), use_bin_type=True)
+        if self.compress and len(payload) >= WEBSOCKET_COMPRESSION_MIN_SIZE:
+            return [{"bytes_data": bytes([FLAG_ZLIB]) + zlib.compress(payload, WEBSOCKET_COMPRESSION_LEVEL)}]
+        return [{"bytes_data": bytes([FLAG_RAW]) + payload}]
+
+
+def select_codec(scope, query):
+    # Subprotocol negotiation wins over the query string
+    subprotocols = scope.get('subprotocols') or []
+    if MSGPACK_ZLIB_SUBPROTOCOL in subprotocols:
+        return MsgpackCodec(compress=True, subprotocol=MSGPACK_ZLIB_SUBPROTOCOL)
+    if MSGPACK_SUBPROTOCOL in subprotocols:
+        return MsgpackCodec(subprotocol=MSGPACK_SUBPROTOCOL)
+    if query.get('format', ['json'])[0] == 'msgpack':
+        return MsgpackCodec(compress=query.get('compress', [''])[0] == 'zlib')
+    return JSONCodec()
+
+
+def build_envelope(uid, seq, room, language, source_language, message, original, **extra):
+    # What a chat client receives for every message: the text in its
+    # language, the original text and where it came from
+    envelope = {
+        "id": uid,
+        "seq": seq,
+        "room": room,
+        "lang": language,
+        "source": source_language,
+        "message": message,
+        "original": original,
+    }
+    envelope.update(extra)
+    return envelope
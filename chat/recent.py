@@ -0,0 +1,164 @@
+import json
+import logging
+from collections import defaultdict, deque
+from django.conf import settings
+from django.utils.module_loading import import_string
+from redis.exceptions import RedisError
+from .fanout import translate_from_sources
+from .redis import get_redis, get_redis_url
+from .translate import display_text
+
+logger = logging.getLogger(__name__)
+
+
+# The last ROOM_BUFFER_SIZE messages of every room are kept with their
+# sequence number, so a client reconnecting with ?since=<seq> gets only the
+# messages it missed
+ROOM_BUFFER_STORE = getattr(settings, 'ROOM_BUFFER_STORE', None)
+ROOM_BUFFER_SIZE = getattr(settings, 'ROOM_BUFFER_SIZE', 500)
+# Buffered messages expire ROOM_BUFFER_TTL after the last message of the
+# room, sequence numbers never do
+ROOM_BUFFER_TTL = getattr(settings, 'ROOM_BUFFER_TTL', 24 * 60 * 60)  # seconds, since the last message
+
+
+class InMemoryRoomBuffer:
+    # Single worker only, for development and tests
+    def __init__(self, size=ROOM_BUFFER_SIZE):
+        self.seqs = defaultdict(int)
+        self.entries = defaultdict(lambda: deque(maxlen=size))
+
+    async def next_seq(self, room):
+        self.seqs[room] += 1
+        return self.seqs[room]
+
+    async def append(self, room, entry):
+        self.entries[room].append(entry)
+
+    async def since(self, room, seq):
+        # Buffered messages after seq, oldest first, and the last sequence
+        # number of the room
+        entries = sorted(
+            (entry for entry in self.entries[room] if entry['seq'] > seq), key=lambda entry: entry['seq']
+        )
+        return entries, self.seqs[room]
+
+
+class RedisRoomBuffer:
+    # Sequence numbers come from INCR and the messages live in a sorted set
+    # scored by sequence number, capped to the newest, shared by every
+    # worker. Reading the messages after a sequence number is a range query
+    # over the gap only.
+    def __init__(self, prefix='room', size=ROOM_BUFFER_SIZE, ttl=ROOM_BUFFER_TTL):
+        self.prefix = prefix
+        self.size = size
+        self.ttl = ttl
+
+    async def next_seq(self, room):
+        return await get_redis().incr(f'{self.prefix}:{room}:seq')
+
+    async def append(self, room, entry):
+        key = f'{self.prefix}:{room}:messages'
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {json.dumps(entry): entry['seq']})
+            pipe.zremrangebyrank(key, 0, -self.size - 1)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def since(self, room, seq):
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.get(f'{self.prefix}:{room}:seq')
+            pipe.zrangebyscore(f'{self.prefix}:{room}:messages', f'({seq}', '+inf')
+            head, entries = await pipe.execute()
+        return [json.loads(entry) for entry in entries], int(head or 0)
+
+
+class RoomBuffer:
+    def __init__(self, store):
+        self.store = store
+
+    async def next_seq(self, room):
+        # Messages are still delivered, without a sequence number, if Redis
+        # is unavailable
+        try:
+            return await self.store.next_seq(room)
+        except (RedisError, OSError) as e:
+            logger.warning("Error assigning a sequence number in %s: %s", room, e)
+            return None
+
+    async def append(self, room, seq, uid, language, src, message, translations):
+        # src is what the translator is told the source language is,
+        # 'auto' while language is only assumed
+        if seq is None:
+            return
+        entry = {
+            'seq': seq,
+            'id': uid,
+            'language': language,
+            'src': src,
+            'message': message,
+            'translations': translations,
+        }
+        try:
+            await self.store.append(room, entry)
+        except (RedisError, OSError) as e:
+            logger.warning("Error buffering message %s of %s: %s", seq, room, e)
+
+    async def since(self, room, seq):
+        # Messages after seq, oldest first, whether messages the client
+        # missed aren't all there (fell out of the buffer or expired), and
+        # whether seq is ahead of the room, so the numbering restarted and
+        # every buffered message is new to the client
+        try:
+            missed, head = await self.store.since(room, seq)
+            reset = seq > head
+            if reset:
+                missed, head = await self.store.since(room, 0)
+        except (RedisError, OSError) as e:
+            logger.warning("Error reading recent messages of %s: %s", room, e)
+            return [], True, False
+        truncated = reset or (head > seq and (not missed or missed[0]['seq'] > seq + 1))
+        return missed, truncated, reset
+
+
+async def translate_entries(entries, language):
+    # Display text of every entry in the given language, translating only
+    # the ones nobody read in that language when they were sent
+    texts = {}
+    missing = []
+    for entry in entries:
+        if entry['language'] == language:
+            texts[entry['seq']] = entry['message']
+        elif language in entry['translations']:
+            texts[entry['seq']] = entry['translations'][language]
+        else:
+            missing.append(entry)
+
+    if missing:
+        try:
+            results = await translate_from_sources(
+                [(entry['message'], entry.get('src', 'auto')) for entry in missing], language
+            )
+        except Exception as e:
+            logger.warning("Error translating replayed messages: %s", e)
+            results = [{'translations': {}} for _ in missing]
+        for entry, result in zip(missing, results):
+            translation = result['translations'].get(language)
+            texts[entry['seq']] = display_text(translation, entry['message']) if translation else entry['message']
+
+    return [texts[entry['seq']] for entry in entries]
+
+
+_buffer = None
+
+
+def get_room_buffer():
+    global _buffer
+    if _buffer is None:
+        if ROOM_BUFFER_STORE:
+            store = import_string(ROOM_BUFFER_STORE)()
+        elif get_redis_url():
+            store = RedisRoomBuffer()
+        else:
+            store = InMemoryRoomBuffer()
+        _buffer = RoomBuffer(store)
+    return _buffer
@@ -0,0 +1,53 @@
+import asyncio
+import weakref
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+
+def get_redis_url():
+    url = getattr(settings, 'REDIS_URL', None)
+    if url:
+        return url
+
+    # Default to the Redis that already backs the channel layer
+    layer = getattr(settings, 'CHANNEL_LAYERS', {}).get('default', {})
+    if not layer.get('BACKEND', '').startswith('channels_redis'):
+        return None
+    host = layer.get('CONFIG', {}).get('hosts', [('127.0.0.1', 6379)])[0]
+    if isinstance(host, str):
+        return host
+    if isinstance(host, dict):
+        return host.get('address')
+    return f'redis://{host[0]}:{host[1]}'
+
+
+# Async clients hold connections bound to the event loop that opened them,
+# so keep one client per loop
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    url = get_redis_url()
+    if url is None:
+        return None
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = aioredis.from_url(url, decode_responses=True)
+        _clients[loop] = client
+    return client
+
+
+# Sync views share one thread safe client and its connection pool
+_sync_client = None
+
+
+def get_sync_redis():
+    global _sync_client
+    url = get_redis_url()
+    if url is None:
+        return None
+    if _sync_client is None:
+        _sync_client = redis.Redis.from_url(url, decode_responses=True)
+    return _sync_client
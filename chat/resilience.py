@@ -0,0 +1,265 @@
+import asyncio
+import time
+from collections import deque
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .metrics import collector, Counter
+
+# Translation backends are wrapped in a circuit breaker each. The primary
+# is tried first, a fallback gets a hedged copy of the call once the primary
+# is slower than its usual TRANSLATION_HEDGE_PERCENTILE latency, and takes
+# over while the primary's breaker is open.
+TRANSLATION_FALLBACK_BACKENDS = getattr(settings, 'TRANSLATION_FALLBACK_BACKENDS', [])
+TRANSLATION_BACKEND_TIMEOUT = getattr(settings, 'TRANSLATION_BACKEND_TIMEOUT', 10)  # seconds
+TRANSLATION_BREAKER_FAILURES = getattr(settings, 'TRANSLATION_BREAKER_FAILURES', 5)
+TRANSLATION_BREAKER_RECOVERY = getattr(settings, 'TRANSLATION_BREAKER_RECOVERY', 30)  # seconds
+TRANSLATION_HEDGE_PERCENTILE = getattr(settings, 'TRANSLATION_HEDGE_PERCENTILE', 95)
+TRANSLATION_HEDGE_MIN_DELAY = getattr(settings, 'TRANSLATION_HEDGE_MIN_DELAY', 0.05)  # seconds
+TRANSLATION_HEDGE_MAX_DELAY = getattr(settings, 'TRANSLATION_HEDGE_MAX_DELAY', 2)  # seconds
+TRANSLATION_LATENCY_WINDOW = getattr(settings, 'TRANSLATION_LATENCY_WINDOW', 200)  # calls
+
+HEDGED_CALLS = Counter(
+    'translation_hedged_calls_total', 'Translation calls also sent to a fallback backend', ['backend']
+)
+HEDGE_WINS = Counter(
+    'translation_hedge_wins_total', 'Hedged translation calls answered by the fallback first', ['backend']
+)
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures and rejects calls
+    # for recovery_time seconds, then lets a single probe through: its
+    # success closes the breaker, its failure opens it again.
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=TRANSLATION_BREAKER_FAILURES, recovery_time=TRANSLATION_BREAKER_RECOVERY):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opened = 0
+
+    def allow(self):
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_time:
+            self.state = self.HALF_OPEN
+            self.probing = False
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+        return self.state == self.CLOSED
+
+    def release(self):
+        # A probe cancelled before it finished proves nothing either way,
+        # let the next call probe instead
+        if self.state == self.HALF_OPEN:
+            self.probing = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class BackendHealth:
+    # Breaker, recent latencies and outcomes of one backend
+    def __init__(self, name, backend, breaker=None, window=TRANSLATION_LATENCY_WINDOW):
+        self.name = name
+        self.backend = backend
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self._percentiles = {}
+
+    def record_success(self, latency):
+        self.successes += 1
+        self.latencies.append(latency)
+        self._percentiles.clear()
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.failures += 1
+        self.breaker.record_failure()
+
+    def latency_percentile(self, percent):
+        if percent not in self._percentiles:
+            latencies = sorted(self.latencies)
+            self._percentiles[percent] = (
+                latencies[min(len(latencies) - 1, round(percent / 100 * (len(latencies) - 1)))]
+                if latencies else None
+            )
+        return self._percentiles[percent]
+
+    def hedge_delay(self, percent=TRANSLATION_HEDGE_PERCENTILE):
+        # Until enough calls were seen, only hedge really slow ones
+        if len(self.latencies) < 20:
+            return TRANSLATION_HEDGE_MAX_DELAY
+        latency = self.latency_percentile(percent)
+        return min(max(latency, TRANSLATION_HEDGE_MIN_DELAY), TRANSLATION_HEDGE_MAX_DELAY)
+
+    def stats(self):
+        return {
+            'state': self.breaker.state,
+            'successes': self.successes,
+            'failures': self.failures,
+            'opened': self.breaker.opened,
+            'p50': self.latency_percentile(50),
+            'p99': self.latency_percentile(99),
+        }
+
+
+class ResilientTranslateBackend:
+    # Same interface as the translation backends, spreading calls over
+    # backends guarded by circuit breakers, with hedging
+    def __init__(self, backends, timeout=TRANSLATION_BACKEND_TIMEOUT, hedge_percentile=TRANSLATION_HEDGE_PERCENTILE):
+        # backends are (name, backend) pairs, the primary first
+        self.healths = [BackendHealth(name, backend) for name, backend in backends]
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+
+    @property
+    def primary(self):
+        return self.healths[0].backend
+
+    async def translate(self, text, dest, src='auto'):
+        return await self.call('translate', text, dest, src)
+
+    async def translate_many(self, texts, dest, src='auto'):
+        return await self.call('translate_many', texts, dest, src)
+
+    async def attempt(self, health, method, args):
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(getattr(health.backend, method)(*args), self.timeout)
+        except Exception:
+            health.record_failure()
+            raise
+        # A batch where every text failed is a failed call
+        if method == 'translate_many' and result and all(isinstance(r, BaseException) for r in result):
+            health.record_failure()
+            raise result[0]
+        health.record_success(time.perf_counter() - start)
+        return result
+
+    def start(self, health, method, args):
+        task = asyncio.ensure_future(self.attempt(health, method, args))
+        # Lost a hedge race or the caller gave up: says nothing about the
+        # backend, but a half open breaker must not wait on it forever
+        task.add_done_callback(lambda task: task.cancelled() and health.breaker.release())
+        return task
+
+    def next_available(self, healths):
+        for health in healths:
+            if health.breaker.allow():
+                return health
+        return None
+
+    async def call(self, method, *args):
+        candidates = iter(self.healths)
+        health = self.next_available(candidates)
+        if health is None:
+            raise BackendUnavailable('Every translation backend is unavailable')
+        # Nothing to hedge or fail over to, skip the race
+        if len(self.healths) == 1:
+            try:
+                return await self.attempt(health, method, args)
+            except asyncio.CancelledError:
+                health.breaker.release()
+                raise
+
+        tasks = {self.start(health, method, args): health}
+        delay = health.hedge_delay(self.hedge_percentile)
+        hedged = False
+        error = None
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(tasks, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Slower than usual: race the next backend, once
+                    fallback = self.next_available(candidates)
+                    if fallback is not None:
+                        HEDGED_CALLS.inc(backend=fallback.name)
+                        tasks[self.start(fallback, method, args)] = fallback
+                        hedged = True
+                    delay = None
+                    continue
+
+                for task in done:
+                    winner = tasks.pop(task)
+                    if task.exception() is None:
+                        if hedged and winner is not self.healths[0]:
+                            HEDGE_WINS.inc(backend=winner.name)
+                        return task.result()
+                    error = task.exception()
+
+                # Failed with nothing else in flight: fail over right away
+                if not tasks:
+                    fallback = self.next_available(candidates)
+                    if fallback is not None:
+                        tasks[self.start(fallback, method, args)] = fallback
+                        delay = None if hedged else fallback.hedge_delay(self.hedge_percentile)
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise error
+
+    def stats(self):
+        return {health.name: health.stats() for health in self.healths}
+
+
+def build_backends(primary, fallbacks=TRANSLATION_FALLBACK_BACKENDS):
+    # fallbacks are {'BACKEND': dotted path, 'OPTIONS': {...}} dicts
+    backends = [('primary', primary)]
+    for i, fallback in enumerate(fallbacks):
+        backend = import_string(fallback['BACKEND'])(**fallback.get('OPTIONS', {}))
+        backends.append((fallback.get('NAME', f'fallback{i + 1}'), backend))
+    return backends
+
+
+_backends = []
+
+
+def track(backend):
+    # Register a ResilientTranslateBackend for the metrics collector
+    _backends.append(backend)
+    return backend
+
+
+@collector
+def translation_backend_metrics():
+    states = [CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN]
+    breaker, calls, opened, latency = [], [], [], []
+    for backend in _backends:
+        for name, stats in backend.stats().items():
+            breaker.append(({'backend': name}, states.index(stats['state'])))
+            calls.append(({'backend': name, 'outcome': 'success'}, stats['successes']))
+            calls.append(({'backend': name, 'outcome': 'failure'}, stats['failures']))
+            opened.append(({'backend': name}, stats['opened']))
+            for quantile, key in (('0.5', 'p50'), ('0.99', 'p99')):
+                if stats[key] is not None:
+                    latency.append(({'backend': name, 'quantile': quantile}, stats[key]))
+    return [
+        ('translation_breaker_state', 'gauge', 'Circuit breaker state, 0 closed, 1 half open, 2 open', breaker),
+        ('translation_backend_calls_total', 'counter', 'Translation backend calls by outcome', calls),
+        ('translation_breaker_opened_total', 'counter', 'Times the circuit breaker opened', opened),
+        ('translation_backend_recent_latency_seconds', 'gauge', 'Latency over the recent calls window', latency),
+    ]
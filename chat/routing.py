@@ -1,6 +1,7 @@
 from django.urls import path
-from .consumers import ChatConsumer
+from .consumers import ChatConsumer, NotificationConsumer
 
 websocket_urlpatterns = [
     path("ws/chat/<str:room_name>/", ChatConsumer.as_asgi()),
+    path("ws/notifications/", NotificationConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -1,6 +1,6 @@
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework import serializers
-from .models import CustomUser
+from .models import Connection, ConnectionRequest, CustomUser
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -13,6 +13,22 @@ class PublicUserSerializer(serializers.ModelSerializer):
         model = CustomUser
         fields = ['id', 'username']  # Add other fields as needed
 
+class ConnectionSerializer(serializers.ModelSerializer):
+    friend = PublicUserSerializer()
+
+    class Meta:
+        model = Connection
+        fields = ['id', 'friend', 'created_at']
+
+
+class ConnectionRequestSerializer(serializers.ModelSerializer):
+    sender = PublicUserSerializer()
+    receiver = PublicUserSerializer()
+
+    class Meta:
+        model = ConnectionRequest
+        fields = ['id', 'sender', 'receiver', 'status', 'created_at']
+
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
     def get_token(cls, user):
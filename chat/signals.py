@@ -0,0 +1,23 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .metrics import count_queries
+from .models import CustomUser
+from .principals import invalidate_user
+from .profiles import invalidate_public_profile
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_user_caches(sender, instance, **kwargs):
+    # Drop the cached profile under both the old and the new username
+    invalidate_public_profile(instance.username, instance.loaded_username)
+    instance.loaded_username = instance.username
+    invalidate_user(instance.pk)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    # Count the queries of every request for the http_db_queries metric
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
@@ -1,3 +1,624 @@
-from django.test import TestCase
+import asyncio
+import json
+import zlib
+from datetime import timedelta
+from unittest import mock
+import msgpack
+from channels.testing import WebsocketCommunicator
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from redis.exceptions import RedisError
+from . import connections
+from .consumers import NotificationConsumer
+from .history import decode_cursor, encode_cursor, get_room_history
+from .models import ChatMessage, Connection, ConnectionRequest, CustomUser
+from .otp import (DatabaseOTPStore, FakeOTPSender, OTPDispatcher, OTPQueueFull, OTPRateLimited, RedisOTPStore,
+                  TwilioOTPSender)
+from .outbound import DEGRADE, DISCONNECT, DROP_OLDEST, OUTBOUND_CLOSE_CODE, OutboundQueue
+from .persistence import MessageWriter
+from .protocol import FLAG_RAW, FLAG_ZLIB, WEBSOCKET_MAX_FRAME_SIZE, MsgpackCodec, ProtocolError
+from .profiles import get_public_profile
+from .recent import InMemoryRoomBuffer, RoomBuffer
+from .resilience import BackendUnavailable, CircuitBreaker, ResilientTranslateBackend
+from .translate import language_label, remove_diacritics, remove_diacritics_many
 
-# Create your tests here.
+
+class FakeBackend:
+    def __init__(self, name, latency=0, fail=False):
+        self.name = name
+        self.latency = latency
+        self.fail = fail
+        self.calls = 0
+
+    async def translate(self, text, dest, src='auto'):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError(f'{self.name} failed')
+        return {'translated_text': f'[{dest}] {text}', 'pronunciation': None, 'detected_language': self.name}
+
+    async def translate_many(self, texts, dest, src='auto'):
+        return [await self.translate(text, dest, src) for text in texts]
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def open_breaker(self, breaker):
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, recovery_time=60)
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.opened, 1)
+
+    def test_half_open_allows_a_single_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=0)
+        self.open_breaker(breaker)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_probe_success_closes(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=0)
+        self.open_breaker(breaker)
+        breaker.allow()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_probe_failure_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=60)
+        self.open_breaker(breaker)
+        breaker.opened_at -= 60
+        breaker.allow()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_released_probe_lets_the_next_call_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=0)
+        self.open_breaker(breaker)
+        breaker.allow()
+        breaker.release()
+        self.assertTrue(breaker.allow())
+
+
+class ResilientTranslateBackendTests(SimpleTestCase):
+    async def test_uses_the_primary(self):
+        primary, fallback = FakeBackend('primary'), FakeBackend('fallback')
+        backend = ResilientTranslateBackend([('primary', primary), ('fallback', fallback)])
+        result = await backend.translate('hi', 'fr')
+        self.assertEqual(result['detected_language'], 'primary')
+        self.assertEqual(fallback.calls, 0)
+
+    async def test_fails_over_to_the_fallback(self):
+        primary, fallback = FakeBackend('primary', fail=True), FakeBackend('fallback')
+        backend = ResilientTranslateBackend([('primary', primary), ('fallback', fallback)])
+        result = await backend.translate('hi', 'fr')
+        self.assertEqual(result['detected_language'], 'fallback')
+        self.assertEqual(backend.stats()['primary']['failures'], 1)
+
+    async def test_open_breaker_skips_the_primary(self):
+        primary, fallback = FakeBackend('primary', fail=True), FakeBackend('fallback')
+        backend = ResilientTranslateBackend([('primary', primary), ('fallback', fallback)])
+        for _ in range(backend.healths[0].breaker.failure_threshold):
+            await backend.translate('hi', 'fr')
+        calls = primary.calls
+        await backend.translate('hi', 'fr')
+        self.assertEqual(primary.calls, calls)
+        self.assertEqual(backend.stats()['primary']['state'], CircuitBreaker.OPEN)
+
+    async def test_hedges_a_slow_primary(self):
+        primary, fallback = FakeBackend('primary'), FakeBackend('fallback')
+        backend = ResilientTranslateBackend([('primary', primary), ('fallback', fallback)])
+        for _ in range(20):
+            await backend.translate('hi', 'fr')
+        primary.latency = 5
+        result = await asyncio.wait_for(backend.translate('hi', 'fr'), 1)
+        self.assertEqual(result['detected_language'], 'fallback')
+
+    async def test_fails_when_every_backend_fails(self):
+        backend = ResilientTranslateBackend([
+            ('primary', FakeBackend('primary', fail=True)), ('fallback', FakeBackend('fallback', fail=True)),
+        ])
+        with self.assertRaises(RuntimeError):
+            await backend.translate('hi', 'fr')
+
+    async def test_unavailable_when_every_breaker_is_open(self):
+        backend = ResilientTranslateBackend([('primary', FakeBackend('primary'))])
+        breaker = backend.healths[0].breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        with self.assertRaises(BackendUnavailable):
+            await backend.translate('hi', 'fr')
+
+    async def test_cancelled_probe_is_released(self):
+        primary = FakeBackend('primary', latency=5)
+        backend = ResilientTranslateBackend([('primary', primary)])
+        breaker = backend.healths[0].breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        breaker.opened_at -= breaker.recovery_time
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(backend.translate('hi', 'fr'), 0.01)
+        primary.latency = 0
+        await backend.translate('hi', 'fr')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    async def test_cancelled_hedge_is_released(self):
+        primary, fallback = FakeBackend('primary'), FakeBackend('fallback', latency=5)
+        backend = ResilientTranslateBackend([('primary', primary), ('fallback', fallback)])
+        for _ in range(20):
+            await backend.translate('hi', 'fr')
+        breaker = backend.healths[1].breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        breaker.opened_at -= breaker.recovery_time
+        primary.latency = 5
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(backend.translate('hi', 'fr'), 0.2)
+        self.assertEqual(fallback.calls, 1)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+
+
+class BrokenRedis:
+    # Stands in for a Redis client, or the Django cache, while Redis is down
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise RedisError('Connection refused')
+        return fail
+
+
+def patch(test, target, new):
+    patcher = mock.patch(target, new)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+class CacheOutageTests(TestCase):
+    def setUp(self):
+        patch(self, 'chat.profiles.cache', BrokenRedis())
+        patch(self, 'chat.principals.cache', BrokenRedis())
+
+    def test_user_save_succeeds(self):
+        with self.assertLogs('chat', 'WARNING'):
+            user = CustomUser.objects.create(mobile='+15550000001', username='alice')
+            user.username = 'alice2'
+            user.save()
+            user.delete()
+
+    def test_public_profile_falls_back_to_the_database(self):
+        with self.assertLogs('chat', 'WARNING'):
+            CustomUser.objects.create(mobile='+15550000002', username='bob', qr_code='qr_codes/bob.png')
+            self.assertEqual(get_public_profile('bob')['username'], 'bob')
+
+
+class RedisOTPStoreFallbackTests(TestCase):
+    def setUp(self):
+        patch(self, 'chat.otp.get_sync_redis', BrokenRedis)
+        patch(self, 'chat.otp.cache', BrokenRedis())
+        self.store = RedisOTPStore()
+        self.store.fallback.cache.clear()
+        self.user = CustomUser.objects.create(mobile='+15550000003')
+
+    def test_issue_and_verify_without_redis(self):
+        with self.assertLogs('chat.otp', 'WARNING'):
+            otp = self.store.issue(self.user.mobile)
+            self.assertFalse(self.store.verify(self.user.mobile, 'x' + otp))
+            self.assertTrue(self.store.verify(self.user.mobile, otp))
+            self.assertFalse(self.store.verify(self.user.mobile, otp))
+
+    @mock.patch('chat.otp.OTP_MAX_ATTEMPTS', 2)
+    def test_attempt_limit_holds_without_redis(self):
+        with self.assertLogs('chat.otp', 'WARNING'):
+            otp = self.store.issue(self.user.mobile)
+            self.store.verify(self.user.mobile, 'x')
+            self.store.verify(self.user.mobile, 'x')
+            with self.assertRaises(OTPRateLimited):
+                self.store.verify(self.user.mobile, otp)
+
+
+class LanguageLabelTests(SimpleTestCase):
+    def test_known_languages_keep_their_label(self):
+        self.assertEqual(language_label('fr'), 'fr')
+        self.assertEqual(language_label('zh-CN'), 'zh-cn')
+
+    def test_unknown_languages_share_a_label(self):
+        self.assertEqual(language_label('not-a-language'), 'other')
+        self.assertEqual(language_label('x' * 1000), 'other')
+
+
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create(mobile='+15550000004')
+
+    def message(self, content):
+        return ChatMessage(room='writer', sender=self.user, content=content, language='en')
+
+    async def test_flushes_a_full_batch(self):
+        writer = MessageWriter(batch_size=2, flush_interval=60)
+        writer.write(self.message('one'))
+        self.assertIsNone(writer._flush_task)
+        writer.write(self.message('two'))
+        writer.write(self.message('three'))
+        await writer._flush_task
+        self.assertEqual(await ChatMessage.objects.filter(room='writer').acount(), 3)
+        self.assertEqual(writer.stats()['written'], 3)
+
+    async def test_flushes_after_the_interval(self):
+        writer = MessageWriter(batch_size=100, flush_interval=0.01)
+        writer.write(self.message('one'))
+        await asyncio.sleep(0.05)
+        await writer._flush_task
+        self.assertEqual(await ChatMessage.objects.filter(room='writer').acount(), 1)
+
+    async def test_close_drains_the_buffer(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60)
+        for i in range(5):
+            writer.write(self.message(str(i)))
+        await writer.close()
+        self.assertEqual(await ChatMessage.objects.filter(room='writer').acount(), 5)
+        self.assertEqual(writer.stats()['queue_depth'], 0)
+
+    async def test_sheds_the_oldest_message_when_full(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, max_queue=2)
+        for content in ('one', 'two', 'three'):
+            writer.write(self.message(content))
+        await writer.close()
+        contents = [m.content async for m in ChatMessage.objects.filter(room='writer').order_by('id')]
+        self.assertEqual(contents, ['two', 'three'])
+        self.assertEqual(writer.stats()['dropped'], 1)
+
+    async def test_retries_a_failed_batch(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, retry_delay=0)
+        save = writer.save
+        failures = [RuntimeError('database is locked')]
+
+        async def flaky_save(batch):
+            if failures:
+                raise failures.pop()
+            await save(batch)
+
+        writer.save = flaky_save
+        writer.write(self.message('one'))
+        with self.assertLogs('chat.persistence', 'WARNING'):
+            await writer.close()
+        self.assertEqual(await ChatMessage.objects.filter(room='writer').acount(), 1)
+        self.assertEqual(writer.stats()['retried'], 1)
+        self.assertEqual(writer.stats()['failed'], 0)
+
+    async def test_gives_up_after_the_retries(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, retries=2, retry_delay=0)
+
+        async def failing_save(batch):
+            raise RuntimeError('database is down')
+
+        writer.save = failing_save
+        writer.write(self.message('one'))
+        with self.assertLogs('chat.persistence', 'ERROR'):
+            await writer.close()
+        self.assertEqual(writer.stats()['retried'], 2)
+        self.assertEqual(writer.stats()['failed'], 1)
+
+
+class NotificationPresenceTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create(mobile='+15550000005', username='alice')
+        self.bob = CustomUser.objects.create(mobile='+15550000006', username='bob')
+        Connection.objects.create(user=self.alice, friend=self.bob)
+        Connection.objects.create(user=self.bob, friend=self.alice)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(), '/ws/notifications/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_events(self, communicator):
+        return json.loads(await communicator.receive_from(timeout=2))['events']
+
+    async def test_only_the_first_and_last_tab_notify_friends(self):
+        bob = await self.connect(self.bob)
+        first_tab = await self.connect(self.alice)
+        self.assertEqual(await self.receive_events(bob), [{'type': 'friend.online', 'user_id': self.alice.pk}])
+
+        second_tab = await self.connect(self.alice)
+        await second_tab.disconnect()
+        self.assertTrue(await bob.receive_nothing(timeout=0.5))
+
+        await first_tab.disconnect()
+        self.assertEqual(await self.receive_events(bob), [{'type': 'friend.offline', 'user_id': self.alice.pk}])
+        await bob.disconnect()
+
+    async def test_offline_friends_are_not_notified(self):
+        with mock.patch('chat.consumers.apublish_many') as publish:
+            alice = await self.connect(self.alice)
+            await alice.disconnect()
+        self.assertEqual([call.args[0] for call in publish.call_args_list], [[], []])
+
+
+class OTPDispatcherTests(TestCase):
+    def test_full_queue_is_rejected(self):
+        dispatcher = OTPDispatcher(FakeOTPSender(), workers=0, max_queue=1)
+        dispatcher.dispatch('+15550000007', '1234')
+        with self.assertRaises(OTPQueueFull):
+            dispatcher.dispatch('+15550000007', '1234')
+        self.assertEqual(dispatcher.sender.outbox, [])
+
+    def test_login_answers_503_when_the_queue_is_full(self):
+        CustomUser.objects.create(mobile='+15550000008')
+        with mock.patch('chat.views.send_otp', side_effect=OTPQueueFull('Too many OTPs')):
+            response = self.client.post('/chat/login/', {'mobile': '+15550000008'}, content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    @override_settings(TWILIO_ACCOUNT_SID=None)
+    def test_twilio_sender_requires_credentials(self):
+        with self.assertRaises(ImproperlyConfigured):
+            TwilioOTPSender()
+
+
+class DiacriticsTests(SimpleTestCase):
+    def test_strips_combining_marks(self):
+        self.assertEqual(remove_diacritics('Crème brûlée'), 'Creme brulee')
+        self.assertEqual(remove_diacritics('Tiếng Việt'), 'Tieng Viet')
+        self.assertEqual(remove_diacritics('hello'), 'hello')
+        self.assertEqual(remove_diacritics(None), '')
+
+    def test_strips_many_texts_at_once(self):
+        self.assertEqual(remove_diacritics_many(['Ça va', None, 'ñ\x00é']), ['Ca va', '', 'n\x00e'])
+
+
+class RoomHistoryTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create(mobile='+15550000009')
+        now = timezone.now()
+        # Two messages share every timestamp, so pages must break ties on id
+        self.messages = [
+            ChatMessage.objects.create(room='history', sender=self.user, content=str(i),
+                                       timestamp=now - timedelta(seconds=i // 2))
+            for i in range(7)
+        ]
+        ChatMessage.objects.create(room='elsewhere', sender=self.user, content='other')
+
+    def test_cursor_round_trip(self):
+        message = self.messages[0]
+        self.assertEqual(decode_cursor(encode_cursor(message)), (message.timestamp, message.pk))
+
+    def test_invalid_cursor(self):
+        for cursor in ('', 'not a cursor', encode_cursor(self.messages[0])[:-4]):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    async def test_pages_cover_the_room_newest_first(self):
+        seen = []
+        before = None
+        while True:
+            page, cursor = await get_room_history('history', before, limit=2)
+            seen.extend(page)
+            if cursor is None:
+                break
+            before = decode_cursor(cursor)
+        expected = sorted(self.messages, key=lambda m: (m.timestamp, m.pk), reverse=True)
+        self.assertEqual([m.pk for m in seen], [m.pk for m in expected])
+
+
+class DatabaseOTPStoreTests(TestCase):
+    def setUp(self):
+        self.store = DatabaseOTPStore(LocMemCache('otp-tests', {}))
+        self.store.cache.clear()
+        self.mobile = '+15550000010'
+        CustomUser.objects.create(mobile=self.mobile)
+
+    def test_an_otp_is_accepted_once(self):
+        otp = self.store.issue(self.mobile)
+        self.assertFalse(self.store.verify(self.mobile, 'x'))
+        self.assertTrue(self.store.verify(self.mobile, otp))
+        self.assertFalse(self.store.verify(self.mobile, otp))
+
+    def test_a_new_otp_replaces_the_old_one(self):
+        old = self.store.issue(self.mobile)
+        new = self.store.issue(self.mobile)
+        if old != new:
+            self.assertFalse(self.store.verify(self.mobile, old))
+        self.assertTrue(self.store.verify(self.mobile, new))
+
+    def test_expired_otp_is_rejected(self):
+        otp = self.store.issue(self.mobile)
+        CustomUser.objects.filter(mobile=self.mobile).update(otp_created=timezone.now() - timedelta(days=1))
+        self.assertFalse(self.store.verify(self.mobile, otp))
+
+    @mock.patch('chat.otp.OTP_MAX_ATTEMPTS', 2)
+    def test_attempt_limit(self):
+        otp = self.store.issue(self.mobile)
+        self.store.verify(self.mobile, 'x')
+        self.store.verify(self.mobile, 'x')
+        with self.assertRaises(OTPRateLimited):
+            self.store.verify(self.mobile, otp)
+
+    @mock.patch('chat.otp.OTP_ISSUE_LIMIT', 1)
+    def test_issue_limit(self):
+        self.store.issue(self.mobile)
+        with self.assertRaises(OTPRateLimited):
+            self.store.issue(self.mobile)
+
+
+class ConnectionTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create(mobile='+15550000011', username='alice')
+        self.bob = CustomUser.objects.create(mobile='+15550000012', username='bob')
+        self.carol = CustomUser.objects.create(mobile='+15550000013', username='carol')
+
+    def test_send_request_is_idempotent(self):
+        request, created, reopened = connections.send_request(self.alice, self.bob)
+        self.assertTrue(created)
+        again, created, reopened = connections.send_request(self.alice, self.bob)
+        self.assertEqual((again.pk, created, reopened), (request.pk, False, False))
+        self.assertEqual(ConnectionRequest.objects.count(), 1)
+
+    def test_send_request_reopens_a_rejected_request(self):
+        request, _, _ = connections.send_request(self.alice, self.bob)
+        connections.reject_requests(self.bob, [request.pk])
+        again, created, reopened = connections.send_request(self.alice, self.bob)
+        self.assertEqual((again.pk, created, reopened, again.status), (request.pk, False, True, 'pending'))
+
+    def test_cannot_connect_with_yourself(self):
+        with self.assertRaises(ValueError):
+            connections.send_request(self.alice, self.alice)
+
+    def test_accept_requests(self):
+        from_alice, _, _ = connections.send_request(self.alice, self.bob)
+        from_carol, _, _ = connections.send_request(self.carol, self.bob)
+        to_carol, _, _ = connections.send_request(self.alice, self.carol)
+
+        accepted = connections.accept_requests(self.bob, [from_alice.pk, from_carol.pk, to_carol.pk])
+        self.assertEqual(sorted(accepted), sorted([(from_alice.pk, self.alice.pk), (from_carol.pk, self.carol.pk)]))
+        self.assertEqual(sorted(connections.get_friend_ids(self.bob.pk)), sorted([self.alice.pk, self.carol.pk]))
+        self.assertEqual(connections.get_friend_ids(self.alice.pk), [self.bob.pk])
+        self.assertEqual(ConnectionRequest.objects.get(pk=to_carol.pk).status, 'pending')
+
+        # Accepting again changes nothing
+        self.assertEqual(connections.accept_requests(self.bob, [from_alice.pk]), [])
+        self.assertEqual(Connection.objects.count(), 4)
+
+
+class MsgpackCodecTests(SimpleTestCase):
+    envelopes = [{'id': 'a', 'seq': 1, 'message': 'héllo'}, {'id': 'b', 'seq': 2, 'message': 'x' * 1000}]
+
+    def test_round_trip(self):
+        for compress in (False, True):
+            codec = MsgpackCodec(compress=compress)
+            [frame] = codec.encode(self.envelopes)
+            self.assertEqual(frame['bytes_data'][0], FLAG_ZLIB if compress else FLAG_RAW)
+            self.assertEqual(codec.decode(bytes_data=frame['bytes_data']), self.envelopes)
+
+    def test_small_payloads_are_not_compressed(self):
+        [frame] = MsgpackCodec(compress=True).encode(self.envelopes[:1])
+        self.assertEqual(frame['bytes_data'][0], FLAG_RAW)
+
+    def test_text_frames_are_json(self):
+        self.assertEqual(MsgpackCodec().decode(text_data='{"message": "hi"}'), {'message': 'hi'})
+
+    def test_rejects_frames_over_the_max_size(self):
+        payload = msgpack.packb('x' * (WEBSOCKET_MAX_FRAME_SIZE + 1))
+        with self.assertRaises(ProtocolError):
+            MsgpackCodec().decode(bytes_data=bytes([FLAG_ZLIB]) + zlib.compress(payload))
+
+    def test_rejects_malformed_frames(self):
+        for frame in (b'', b'\x07abc', bytes([FLAG_ZLIB]) + b'not zlib', bytes([FLAG_RAW]) + b'\xc1'):
+            with self.assertRaises(ProtocolError):
+                MsgpackCodec().decode(bytes_data=frame)
+
+
+class FakeConsumer:
+    channel_name = 'fake'
+
+    def __init__(self):
+        self.frames = []
+        self.close_code = None
+
+    async def send_envelopes(self, envelopes):
+        self.frames.append(envelopes)
+
+    async def close(self, code=None):
+        self.close_code = code
+
+
+class OutboundQueueTests(SimpleTestCase):
+    async def drain(self, queue):
+        if queue._sender is not None:
+            await queue._sender
+
+    async def test_drop_oldest(self):
+        consumer = FakeConsumer()
+        queue = OutboundQueue(consumer, max_size=2, batch_window=0, policy=DROP_OLDEST)
+        for seq in (1, 2, 3):
+            queue.put({'seq': seq})
+        await self.drain(queue)
+        self.assertEqual(consumer.frames, [[{'seq': 2}, {'seq': 3}]])
+        self.assertEqual(queue.stats()['dropped'], 1)
+        self.assertFalse(queue.degraded)
+
+    async def test_disconnect(self):
+        consumer = FakeConsumer()
+        queue = OutboundQueue(consumer, max_size=2, batch_window=0, policy=DISCONNECT)
+        for seq in (1, 2, 3):
+            queue.put({'seq': seq})
+        await asyncio.sleep(0)
+        self.assertTrue(queue.closed)
+        self.assertEqual(consumer.close_code, OUTBOUND_CLOSE_CODE)
+        self.assertEqual(consumer.frames, [])
+        queue.put({'seq': 4})
+        self.assertEqual(queue.stats()['queue_depth'], 0)
+
+    async def test_degrade_until_the_queue_drains(self):
+        consumer = FakeConsumer()
+        queue = OutboundQueue(consumer, max_size=2, batch_window=0, policy=DEGRADE)
+        for seq in (1, 2, 3):
+            queue.put({'seq': seq})
+        self.assertTrue(queue.degraded)
+        await self.drain(queue)
+        self.assertFalse(queue.degraded)
+        self.assertEqual(consumer.frames, [[{'seq': 2}, {'seq': 3}]])
+
+    async def test_batches_a_burst(self):
+        consumer = FakeConsumer()
+        queue = OutboundQueue(consumer, batch_window=0.01, batch_size=3)
+        for seq in range(5):
+            queue.put({'seq': seq})
+        await self.drain(queue)
+        self.assertEqual([len(frame) for frame in consumer.frames], [3, 2])
+
+
+class RoomBufferTests(SimpleTestCase):
+    async def build_buffer(self):
+        # Five messages through a buffer that keeps the last three
+        buffer = RoomBuffer(InMemoryRoomBuffer(size=3))
+        for _ in range(5):
+            seq = await buffer.next_seq('room')
+            await buffer.append('room', seq, f'id-{seq}', 'en', 'auto', f'message {seq}', {})
+        return buffer
+
+    def seqs(self, entries):
+        return [entry['seq'] for entry in entries]
+
+    async def test_only_the_gap_is_returned(self):
+        buffer = await self.build_buffer()
+        missed, truncated, reset = await buffer.since('room', 3)
+        self.assertEqual((self.seqs(missed), truncated, reset), ([4, 5], False, False))
+
+    async def test_up_to_date(self):
+        buffer = await self.build_buffer()
+        missed, truncated, reset = await buffer.since('room', 5)
+        self.assertEqual((missed, truncated, reset), ([], False, False))
+
+    async def test_truncated_when_the_gap_fell_out_of_the_buffer(self):
+        buffer = await self.build_buffer()
+        missed, truncated, reset = await buffer.since('room', 1)
+        self.assertEqual((self.seqs(missed), truncated, reset), ([3, 4, 5], True, False))
+
+    async def test_reset_when_the_client_is_ahead(self):
+        buffer = await self.build_buffer()
+        missed, truncated, reset = await buffer.since('room', 9)
+        self.assertEqual((self.seqs(missed), truncated, reset), ([3, 4, 5], True, True))
+
+    async def test_store_errors_report_truncation(self):
+        buffer = await self.build_buffer()
+        buffer.store = BrokenRedis()
+        with self.assertLogs('chat.recent', 'WARNING'):
+            self.assertEqual(await buffer.since('room', 3), ([], True, False))
@@ -0,0 +1,327 @@
+import asyncio
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, lru_cache
+from django.conf import settings
+from django.utils.module_loading import import_string
+from googletrans import LANGUAGES, Translator
+from .cache import TranslationCache
+from .http import get_session, request_timeout
+from .metrics import collector, TRANSLATION_ERRORS, TRANSLATION_LATENCY
+from .resilience import build_backends, ResilientTranslateBackend, track
+
+
+TRANSLATION_BACKEND = getattr(settings, 'TRANSLATION_BACKEND', 'chat.translate.GoogleTranslateBackend')
+TRANSLATION_BACKEND_OPTIONS = getattr(settings, 'TRANSLATION_BACKEND_OPTIONS', {})
+TRANSLATION_MAX_WORKERS = getattr(settings, 'TRANSLATION_MAX_WORKERS', 8)
+TRANSLATION_CACHE_SIZE = getattr(settings, 'TRANSLATION_CACHE_SIZE', 10000)
+TRANSLATION_CACHE_TTL = getattr(settings, 'TRANSLATION_CACHE_TTL', 3600)  # seconds
+TRANSLATION_CACHE_REDIS = getattr(settings, 'TRANSLATION_CACHE_REDIS', True)
+TRANSLATION_CACHE_REDIS_TTL = getattr(settings, 'TRANSLATION_CACHE_REDIS_TTL', 86400)  # seconds
+DIACRITICS_CACHE_SIZE = getattr(settings, 'DIACRITICS_CACHE_SIZE', 4096)
+DIACRITICS_CACHE_MAX_LENGTH = getattr(settings, 'DIACRITICS_CACHE_MAX_LENGTH', 1000)  # characters
+
+
+class TranslationError(Exception):
+    pass
+
+
+def build_diacritics_table():
+    # Maps every combining mark to nothing and every character with a
+    # canonical decomposition (Hangul syllables included) to that
+    # decomposition minus its marks. str.translate with it gives the same
+    # result as NFD followed by dropping the Mn characters, in one pass in C.
+    # Planes 3 to 13, 15 and 16 hold neither.
+    category = unicodedata.category
+    decomposition = unicodedata.decomposition
+    normalize = unicodedata.normalize
+    table = {}
+    for start, stop in ((0, 0x30000), (0xE0000, 0xE1000)):
+        for codepoint in range(start, stop):
+            char = chr(codepoint)
+            if category(char) == 'Mn':
+                table[codepoint] = None
+            elif decomposition(char)[:1] not in ('', '<') or 0xAC00 <= codepoint <= 0xD7A3:
+                stripped = ''.join(c for c in normalize('NFD', char) if category(c) != 'Mn')
+                if stripped != char:
+                    table[codepoint] = stripped
+    return table
+
+
+@cache
+def get_diacritics_table():
+    # Built on first use, so processes that never strip diacritics don't pay
+    # for scanning every code point
+    return build_diacritics_table()
+
+
+@lru_cache(maxsize=DIACRITICS_CACHE_SIZE)
+def _remove_diacritics(text):
+    return text.translate(get_diacritics_table())
+
+
+def remove_diacritics(text):
+    if not text:
+        return ''
+    if text.isascii():
+        return text
+    # Long texts rarely repeat, keep them out of the cache
+    if len(text) > DIACRITICS_CACHE_MAX_LENGTH:
+        return text.translate(get_diacritics_table())
+    return _remove_diacritics(text)
+
+
+def remove_diacritics_many(texts):
+    # Strip many texts in a single translate call, joined on NUL which the
+    # table leaves alone
+    texts = [text or '' for text in texts]
+    joined = '\x00'.join(texts)
+    if joined.isascii():
+        return texts
+    if joined.count('\x00') != len(texts) - 1:
+        return [remove_diacritics(text) for text in texts]
+    return joined.translate(get_diacritics_table()).split('\x00')
+
+
+def build_result(translated_text, pronunciation, detected_language):
+    # Same shape as the translate_text JSON response
+    translated_text = translated_text if translated_text else ''
+    return {
+        'translated_text': translated_text,
+        'pronunciation': pronunciation if pronunciation else remove_diacritics(translated_text),
+        'detected_language': detected_language,
+    }
+
+
+def build_results(items):
+    # build_result for many (translated_text, pronunciation,
+    # detected_language) items, romanizing the missing pronunciations in
+    # one pass
+    items = [(text if text else '', pronunciation, detected_language) for text, pronunciation, detected_language in items]
+    missing = [i for i, (_, pronunciation, _) in enumerate(items) if not pronunciation]
+    stripped = dict(zip(missing, remove_diacritics_many([items[i][0] for i in missing])))
+    return [
+        {
+            'translated_text': text,
+            'pronunciation': pronunciation if pronunciation else stripped[i],
+            'detected_language': detected_language,
+        }
+        for i, (text, pronunciation, detected_language) in enumerate(items)
+    ]
+
+
+def language_label(language):
+    # Metric label for a destination language. Languages come from clients,
+    # so anything unknown shares one series instead of adding a new one.
+    language = str(language).lower()
+    return language if language in LANGUAGES else 'other'
+
+
+def display_text(result, fallback=''):
+    # What the chat shows: pronunciation, else the translated text
+    return result['pronunciation'] or result['translated_text'] or fallback
+
+
+class BaseTranslateBackend:
+    async def translate(self, text, dest, src='auto'):
+        raise NotImplementedError
+
+    async def translate_many(self, texts, dest, src='auto'):
+        # Results in the order of texts, with the exception in place of any
+        # text that failed. Backends that can group upstream calls override it.
+        return await asyncio.gather(
+            *(self.translate(text, dest, src) for text in texts),
+            return_exceptions=True,
+        )
+
+
+class GoogleTranslateBackend(BaseTranslateBackend):
+    def __init__(self, max_workers=TRANSLATION_MAX_WORKERS):
+        self.translator = Translator()
+        # Bounded pool so blocking upstream calls can't take every thread
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='googletrans')
+
+    def translate_sync(self, text, dest, src='auto'):
+        translation = self.translator.translate(text, dest=dest, src=src)
+        if not translation:
+            raise TranslationError('Translation failed')
+        return build_result(translation.text, translation.pronunciation, translation.src)
+
+    def translate_many_sync(self, texts, dest, src='auto'):
+        # googletrans takes a list and translates it on one client session
+        try:
+            translations = self.translator.translate(list(texts), dest=dest, src=src)
+            return build_results([(t.text, t.pronunciation, t.src) for t in translations])
+        except Exception:
+            pass
+
+        # One bad text fails the whole list, retry one by one to isolate it
+        results = []
+        for text in texts:
+            try:
+                results.append(self.translate_sync(text, dest, src))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def translate(self, text, dest, src='auto'):
+        # googletrans blocks on the network, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.translate_sync, text, dest, src)
+
+    async def translate_many(self, texts, dest, src='auto'):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.translate_many_sync, texts, dest, src)
+
+
+class StubTranslateBackend(BaseTranslateBackend):
+    # Deterministic local translations for tests and benchmarks
+    def __init__(self, latency=0, detected_language='en'):
+        self.latency = latency
+        self.detected_language = detected_language
+
+    async def translate(self, text, dest, src='auto'):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        detected_language = self.detected_language if src == 'auto' else src
+        return build_result(f'[{dest}] {text}', None, detected_language)
+
+
+class HttpTranslateBackend(BaseTranslateBackend):
+    # A remote service speaking the translate_text JSON protocol. Never point
+    # this at our own translate_text view, which uses this module itself.
+    def __init__(self, url, timeout=None):
+        self.url = url
+        self.timeout = timeout
+
+    async def translate(self, text, dest, src='auto'):
+        payload = {"input_text": text, "dest": dest}
+        session = get_session()
+        async with session.post(self.url, json=payload, timeout=request_timeout(self.timeout)) as response:
+            if response.status != 200:
+                raise TranslationError(f'Translation API returned {response.status}')
+            data = await response.json()
+        return build_result(data.get('translated_text'), data.get('pronunciation'), data.get('detected_language'))
+
+
+class TranslationService:
+    def __init__(self, backend, cache=None):
+        self.backend = backend
+        self.cache = cache
+
+    async def get_cached(self, text, dest, src='auto'):
+        if self.cache is None:
+            return None
+        return await self.cache.get(text, dest, src)
+
+    async def translate(self, text, dest, src='auto'):
+        result = await self.get_cached(text, dest, src)
+        if result is not None:
+            return result
+        return await self.translate_uncached(text, dest, src)
+
+    async def translate_uncached(self, text, dest, src='auto'):
+        # Straight to the backend, for callers that already missed the cache
+        try:
+            with TRANSLATION_LATENCY.time(language=language_label(dest)):
+                result = await self.backend.translate(text, dest, src)
+        except Exception:
+            TRANSLATION_ERRORS.inc(language=language_label(dest))
+            raise
+
+        if self.cache is not None:
+            await self.cache.set(text, dest, result, src)
+        return result
+
+    async def translate_batch(self, texts, dests, src='auto'):
+        # Translate every text into every destination language. Duplicate
+        # texts are translated once and cache misses for a language go to
+        # the backend in a single grouped call. Results follow the order of
+        # texts, each with its translations and errors keyed by language.
+        unique_texts = list(dict.fromkeys(texts))
+        dests = list(dict.fromkeys(dests))
+
+        per_language = await asyncio.gather(
+            *(self._translate_language(unique_texts, dest, src) for dest in dests)
+        )
+
+        by_text = {text: {'translations': {}, 'errors': {}} for text in unique_texts}
+        for dest, results in zip(dests, per_language):
+            for text, result in zip(unique_texts, results):
+                if isinstance(result, BaseException):
+                    by_text[text]['errors'][dest] = str(result) or result.__class__.__name__
+                else:
+                    by_text[text]['translations'][dest] = result
+
+        return [
+            {
+                'input_text': text,
+                'translations': dict(by_text[text]['translations']),
+                'errors': dict(by_text[text]['errors']),
+            }
+            for text in texts
+        ]
+
+    async def _translate_language(self, texts, dest, src):
+        results = [await self.get_cached(text, dest, src) for text in texts]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return results
+
+        try:
+            with TRANSLATION_LATENCY.time(language=language_label(dest)):
+                translated = await self.backend.translate_many([texts[i] for i in misses], dest, src)
+        except Exception as e:
+            translated = [e] * len(misses)
+        failed = sum(1 for result in translated if isinstance(result, BaseException))
+        if failed:
+            TRANSLATION_ERRORS.inc(failed, language=language_label(dest))
+
+        for i, result in zip(misses, translated):
+            results[i] = result
+            if self.cache is not None and not isinstance(result, BaseException):
+                await self.cache.set(texts[i], dest, result, src)
+        return results
+
+
+_service = None
+
+
+def get_translation_service():
+    global _service
+    if _service is None:
+        backend = import_string(TRANSLATION_BACKEND)(**TRANSLATION_BACKEND_OPTIONS)
+        backend = track(ResilientTranslateBackend(build_backends(backend)))
+        cache = TranslationCache(
+            max_size=TRANSLATION_CACHE_SIZE,
+            ttl=TRANSLATION_CACHE_TTL,
+            redis_ttl=TRANSLATION_CACHE_REDIS_TTL,
+            use_redis=TRANSLATION_CACHE_REDIS,
+        )
+        _service = TranslationService(backend, cache)
+    return _service
+
+
+@collector
+def translation_cache_metrics():
+    if _service is None or _service.cache is None:
+        return []
+    stats = _service.cache.stats()
+    local, redis = stats['local'], stats['redis']
+    return [
+        ('translation_cache_hits_total', 'counter', 'Translation cache hits', [
+            ({'tier': 'local'}, local['hits']),
+            ({'tier': 'redis'}, redis['hits']),
+        ]),
+        ('translation_cache_misses_total', 'counter', 'Translation cache misses', [
+            ({'tier': 'local'}, local['misses']),
+            ({'tier': 'redis'}, redis['misses']),
+        ]),
+        ('translation_cache_size', 'gauge', 'Entries in the local translation cache', [({}, local['size'])]),
+        ('translation_cache_evictions_total', 'counter', 'Local translation cache evictions', [
+            ({}, local['evictions']),
+        ]),
+        ('translation_cache_redis_errors_total', 'counter', 'Failed Redis translation cache calls', [
+            ({}, redis['errors']),
+        ]),
+    ]
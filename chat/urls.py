@@ -6,7 +6,19 @@ from .views import (RegisterView,
                     SetUsernameView, 
                     UserView, 
                     PublicUserView,
-                    translate_text)
+                    translate_text,
+                    translate_batch,
+                    room_history,
+                    send_connection_request,
+                    accept_connection_request,
+                    reject_connection_request,
+                    bulk_accept_connection_requests,
+                    bulk_reject_connection_requests,
+                    list_connections,
+                    list_incoming_connection_requests,
+                    list_outgoing_connection_requests,
+                    list_mutual_connections,
+                    metrics)
 
 chat_urls = [
     path('register/', RegisterView.as_view(), name='register'),
@@ -17,4 +29,16 @@ chat_urls = [
     path('user/', UserView.as_view(), name='user'),
     path('user/<str:username>/', PublicUserView.as_view(), name='public-user'),
     path('translate/', translate_text, name='translate_text'),
+    path('translate/batch/', translate_batch, name='translate_batch'),
+    path('rooms/<str:room_name>/messages/', room_history, name='room_history'),
+    path('metrics/', metrics, name='metrics'),
+    path('connections/', list_connections, name='connections'),
+    path('connections/mutual/<int:user_id>/', list_mutual_connections, name='mutual-connections'),
+    path('connections/requests/incoming/', list_incoming_connection_requests, name='incoming-connection-requests'),
+    path('connections/requests/outgoing/', list_outgoing_connection_requests, name='outgoing-connection-requests'),
+    path('connections/requests/accept/', bulk_accept_connection_requests, name='bulk-accept-connection-requests'),
+    path('connections/requests/reject/', bulk_reject_connection_requests, name='bulk-reject-connection-requests'),
+    path('connections/requests/send/<int:receiver_id>/', send_connection_request, name='send-connection-request'),
+    path('connections/requests/<int:request_id>/accept/', accept_connection_request, name='accept-connection-request'),
+    path('connections/requests/<int:request_id>/reject/', reject_connection_request, name='reject-connection-request'),
 ]
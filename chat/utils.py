@@ -1,36 +1,116 @@
-from twilio.rest import Client
+import asyncio
+import hashlib
+import logging
+import time
 import qrcode
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import BytesIO
-from django.core.files import File
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from .lifespan import on_shutdown
+from .otp import get_otp_dispatcher
+from .principals import invalidate_user
+
+logger = logging.getLogger(__name__)
+
+
+QR_CODE_WORKERS = getattr(settings, 'QR_CODE_WORKERS', 2)
+QR_CODE_CACHE_SIZE = getattr(settings, 'QR_CODE_CACHE_SIZE', 1024)  # rendered images kept in memory
+QR_CODE_UPLOAD_ATTEMPTS = getattr(settings, 'QR_CODE_UPLOAD_ATTEMPTS', 3)
+QR_CODE_UPLOAD_RETRY_DELAY = getattr(settings, 'QR_CODE_UPLOAD_RETRY_DELAY', 1)  # seconds, doubled per retry
+
+# Bump when the rendering parameters below change, so new images get new names
+QR_CODE_VERSION = 1
+
+qr_code_executor = ThreadPoolExecutor(max_workers=QR_CODE_WORKERS, thread_name_prefix='qr-code')
 
 def send_otp(mobile, otp):
-    account_sid = "AC764f1b73362ebab73be5e7cba710bbc8"
-    auth_token = "8bb8ffbb6ab867dc8683c41ec0474ec4"
-    client = Client(account_sid, auth_token)
-    message = client.messages.create(
-        body=f'Your OTP for Babel-on is: {otp}',
-        from_='+12054988451',  # Your Twilio phone number
-        to=mobile
-    )
+    # Queued and sent in the background, the caller doesn't wait for the SMS
+    get_otp_dispatcher().dispatch(mobile, otp)
 
-    print(message.sid)
 
 
 
+def get_profile_url(username):
+    return f'http://localhost:8000/user/{username}'  # Adjust based on your URL pattern
 
-def generate_qr_code(user):
+
+@lru_cache(maxsize=QR_CODE_CACHE_SIZE)
+def render_qr_code(profile_url):
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
         box_size=10,
         border=4,
     )
-    profile_url = f'http://localhost:8000/user/{user.username}'  # Adjust based on your URL pattern
     qr.add_data(profile_url)
     qr.make(fit=True)
 
     img = qr.make_image(fill='black', back_color='white')
     buffer = BytesIO()
     img.save(buffer, format='PNG')
-    file_name = f'qr_code-{user.username}.png'
-    user.qr_code.save(file_name, File(buffer), save=False)
+    return buffer.getvalue()
+
+
+def get_qr_code_name(profile_url):
+    # Content addressed: the same profile URL always renders the same image,
+    # so it always maps to the same object
+    digest = hashlib.sha256(f'{QR_CODE_VERSION}:{profile_url}'.encode()).hexdigest()
+    return f'qr_codes/{digest}.png'
+
+
+def upload_qr_code(name, profile_url, attempts=QR_CODE_UPLOAD_ATTEMPTS):
+    for attempt in range(attempts):
+        try:
+            if default_storage.exists(name):
+                return name
+            return default_storage.save(name, ContentFile(render_qr_code(profile_url)))
+        except Exception as e:
+            if attempt + 1 == attempts:
+                raise
+            logger.warning("Error uploading QR code %s, retrying: %s", name, e)
+            time.sleep(QR_CODE_UPLOAD_RETRY_DELAY * 2 ** attempt)
+
+
+def clear_qr_code(name):
+    # Users pointing at a QR code that couldn't be uploaded get none, so it
+    # is generated again the next time their profile is requested
+    from .profiles import invalidate_public_profile
+
+    users = get_user_model().objects.filter(qr_code=name)
+    cleared = list(users.values_list('pk', 'username'))
+    users.update(qr_code=None)
+    for pk, username in cleared:
+        invalidate_user(pk)
+        invalidate_public_profile(username)
+
+
+def _upload_done(name, future):
+    if future.cancelled() or future.exception() is None:
+        return
+    logger.error("Error uploading QR code %s", name, exc_info=future.exception())
+    try:
+        clear_qr_code(name)
+    except Exception:
+        logger.exception("Error clearing QR code %s", name)
+
+
+def generate_qr_code(user):
+    # Point the user at their QR code and render and upload it in the
+    # background. Nothing is rendered for users without a username yet.
+    if not user.username:
+        return None
+    profile_url = get_profile_url(user.username)
+    name = get_qr_code_name(profile_url)
+    user.qr_code.name = name
+    future = qr_code_executor.submit(upload_qr_code, name, profile_url)
+    future.add_done_callback(lambda future: _upload_done(name, future))
+    return future
+
+
+@on_shutdown
+async def close_qr_code_executor():
+    await asyncio.to_thread(qr_code_executor.shutdown, wait=True)
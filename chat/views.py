@@ -1,38 +1,70 @@
 from .models import CustomUser
-from django.utils import timezone
 from django.conf import settings
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from .otp import get_otp_store, OTPQueueFull, OTPRateLimited
+from .principals import invalidate_user
+from .profiles import get_media_url, get_public_profile
 from .utils import send_otp, generate_qr_code
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.permissions import IsAuthenticated
-from .serializers import UserSerializer, PublicUserSerializer
+from .serializers import UserSerializer, ConnectionSerializer, ConnectionRequestSerializer
+from . import connections
+from .notifications import connection_request_event, publish, publish_many
 from rest_framework.decorators import api_view, permission_classes
 from .models import ConnectionRequest, CustomUser
 from django.shortcuts import get_object_or_404
 
-import unicodedata
-from googletrans import Translator
-from django.http import JsonResponse
+from .history import (decode_cursor, get_room_history, get_translations, serialize_message,
+                      HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE)
+from .limits import ConcurrencyLimiter, Saturated
+from .metrics import collector, render
+from .resilience import BackendUnavailable, TRANSLATION_BREAKER_RECOVERY
+from .translate import get_translation_service
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 import json
 
 
 OTP_EXPIRATION_TIME = getattr(settings, 'OTP_EXPIRATION_TIME', 5)  # minutes
-
-translator = Translator()
-
-def remove_diacritics(text):
-    if not text:
-        return ''
-    normalized_text = unicodedata.normalize('NFD', text)
-    return ''.join(char for char in normalized_text if unicodedata.category(char) != 'Mn')
+TRANSLATION_MAX_CONCURRENCY = getattr(settings, 'TRANSLATION_MAX_CONCURRENCY', 16)
+TRANSLATION_MAX_QUEUE = getattr(settings, 'TRANSLATION_MAX_QUEUE', 64)
+TRANSLATION_QUEUE_TIMEOUT = getattr(settings, 'TRANSLATION_QUEUE_TIMEOUT', 2)  # seconds
+TRANSLATION_BATCH_MAX_ITEMS = getattr(settings, 'TRANSLATION_BATCH_MAX_ITEMS', 500)  # texts x languages
+METRICS_ALLOWED_IPS = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])  # None allows every client
+
+translation_limiter = ConcurrencyLimiter(
+    TRANSLATION_MAX_CONCURRENCY, TRANSLATION_MAX_QUEUE, TRANSLATION_QUEUE_TIMEOUT
+)
+
+
+@collector
+def translation_limiter_metrics():
+    stats = translation_limiter.stats()
+    return [
+        ('translation_requests_active', 'gauge', 'Translation requests holding a limiter slot', [
+            ({}, stats['active']),
+        ]),
+        ('translation_requests_waiting', 'gauge', 'Translation requests queued for a slot', [({}, stats['waiting'])]),
+        ('translation_requests_rejected_total', 'counter', 'Translation requests rejected as saturated', [
+            ({}, stats['rejected']),
+        ]),
+    ]
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    # Prometheus text exposition of this worker's metrics
+    if METRICS_ALLOWED_IPS is not None and request.META.get('REMOTE_ADDR') not in METRICS_ALLOWED_IPS:
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @require_http_methods(["POST"])
 @csrf_exempt
-def translate_text(request):
+async def translate_text(request):
     try:
         data = json.loads(request.body)
         input_text = data.get('input_text')
@@ -41,52 +73,204 @@ def translate_text(request):
         if not input_text:
             return JsonResponse({'error': 'Input text is empty'}, status=400)
 
-        translation = translator.translate(input_text, dest=dest_language)
-
-        if not translation:
-            return JsonResponse({'error': 'Translation failed'}, status=500)
+        service = get_translation_service()
 
-        translated_text = translation.text if translation.text else ''
-        pronunciation = translation.pronunciation if translation.pronunciation else remove_diacritics(translated_text)
+        # Cache hits are answered without taking a slot from the limiter
+        result = await service.get_cached(input_text, dest_language)
+        if result is None:
+            async with translation_limiter.acquire():
+                result = await service.translate_uncached(input_text, dest_language)
 
         return JsonResponse({
-            'translated_text': translated_text,
-            'pronunciation': pronunciation,
-            'detected_language': translation.src
+            'translated_text': result['translated_text'],
+            'pronunciation': result['pronunciation'],
+            'detected_language': result['detected_language']
         })
+    except Saturated as e:
+        return JsonResponse({'error': f'Translation service is busy: {e}'}, status=503, headers={'Retry-After': '1'})
+    except BackendUnavailable as e:
+        return JsonResponse({'error': str(e)}, status=503, headers={'Retry-After': str(TRANSLATION_BREAKER_RECOVERY)})
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@require_http_methods(["POST"])
+@csrf_exempt
+async def translate_batch(request):
+    try:
+        data = json.loads(request.body)
+        input_texts = data.get('input_texts')
+        dest_languages = data.get('dests', ['en'])
+        src_language = data.get('src', 'auto')
+
+        if not input_texts or not isinstance(input_texts, list):
+            return JsonResponse({'error': 'input_texts must be a non-empty list'}, status=400)
+        if not all(isinstance(text, str) for text in input_texts):
+            return JsonResponse({'error': 'input_texts must be a list of strings'}, status=400)
+        if not dest_languages or not isinstance(dest_languages, list):
+            return JsonResponse({'error': 'dests must be a non-empty list'}, status=400)
+        if not all(isinstance(dest, str) for dest in dest_languages):
+            return JsonResponse({'error': 'dests must be a list of strings'}, status=400)
+        if not isinstance(src_language, str):
+            return JsonResponse({'error': 'src must be a string'}, status=400)
+        if len(set(input_texts)) * len(set(dest_languages)) > TRANSLATION_BATCH_MAX_ITEMS:
+            return JsonResponse({'error': f'A batch may hold at most {TRANSLATION_BATCH_MAX_ITEMS} translations'}, status=400)
+
+        async with translation_limiter.acquire():
+            results = await get_translation_service().translate_batch(input_texts, dest_languages, src_language)
+
+        return JsonResponse({'results': results})
+    except Saturated as e:
+        return JsonResponse({'error': f'Translation service is busy: {e}'}, status=503, headers={'Retry-After': '1'})
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+@require_http_methods(["GET"])
+async def room_history(request, room_name):
+    try:
+        limit = min(int(request.GET.get('limit', HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE)
+        before = request.GET.get('before')
+        before = decode_cursor(before) if before else None
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if limit < 1:
+        return JsonResponse({'error': 'limit must be positive'}, status=400)
+
+    messages, next_cursor = await get_room_history(room_name, before, limit)
+
+    language = request.GET.get('lang')
+    if language:
+        translations = await get_translations(messages, language, translation_limiter)
+    else:
+        translations = [None] * len(messages)
+
+    return JsonResponse({
+        'messages': [serialize_message(m, t) for m, t in zip(messages, translations)],
+        'next': next_cursor,
+    })
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def send_connection_request(request, receiver_id):
     receiver = get_object_or_404(CustomUser, id=receiver_id)
-    ConnectionRequest.objects.create(sender=request.user, receiver=receiver)
-    return Response({'message': 'Connection request sent'}, status=status.HTTP_200_OK)
+    try:
+        connection_request, created, reopened = connections.send_request(request.user, receiver)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    # Repeating a request doesn't notify the receiver again
+    if created or reopened:
+        publish(receiver.id, connection_request_event('connection.request.received', connection_request.id, request.user))
+    return Response({
+        'message': 'Connection request sent' if created or reopened else 'Connection request already sent',
+        'request_id': connection_request.id,
+        'status': connection_request.status
+        }, status=status.HTTP_200_OK)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def accept_connection_request(request, request_id):
     connection_request = get_object_or_404(ConnectionRequest, id=request_id, receiver=request.user)
-    connection_request.status = 'accepted'
-    connection_request.save()
+    accepted = connections.accept_requests(request.user, [connection_request.id])
+    if not accepted:
+        # Only pending requests can be accepted
+        return Response({'error': f'Connection request is {connection_request.status}'}, status=status.HTTP_409_CONFLICT)
+    publish_request_events('connection.request.accepted', accepted, request.user)
     return Response({'message': 'Connection request accepted'}, status=status.HTTP_200_OK)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def reject_connection_request(request, request_id):
     connection_request = get_object_or_404(ConnectionRequest, id=request_id, receiver=request.user)
-    connection_request.status = 'rejected'
-    connection_request.save()
+    rejected = connections.reject_requests(request.user, [connection_request.id])
+    if not rejected:
+        return Response({'error': f'Connection request is {connection_request.status}'}, status=status.HTTP_409_CONFLICT)
+    publish_request_events('connection.request.rejected', rejected, request.user)
     return Response({'message': 'Connection request rejected'}, status=status.HTTP_200_OK)
 
+def publish_request_events(event_type, requests, user):
+    # Tell the senders of (request_id, sender_id) pairs what user decided
+    publish_many([
+        (sender_id, connection_request_event(event_type, request_id, user))
+        for request_id, sender_id in requests
+    ])
+
+def get_request_ids(request):
+    request_ids = request.data.get('request_ids')
+    if not isinstance(request_ids, list) or not all(isinstance(i, int) for i in request_ids):
+        return None
+    return request_ids[:connections.CONNECTIONS_MAX_PAGE_SIZE]
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def bulk_accept_connection_requests(request):
+    request_ids = get_request_ids(request)
+    if request_ids is None:
+        return Response({'error': 'request_ids must be a list of ids'}, status=status.HTTP_400_BAD_REQUEST)
+    accepted = connections.accept_requests(request.user, request_ids)
+    publish_request_events('connection.request.accepted', accepted, request.user)
+    return Response({'accepted': [pk for pk, _ in accepted]}, status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def bulk_reject_connection_requests(request):
+    request_ids = get_request_ids(request)
+    if request_ids is None:
+        return Response({'error': 'request_ids must be a list of ids'}, status=status.HTTP_400_BAD_REQUEST)
+    rejected = connections.reject_requests(request.user, request_ids)
+    publish_request_events('connection.request.rejected', rejected, request.user)
+    return Response({'rejected': [pk for pk, _ in rejected]}, status=status.HTTP_200_OK)
+
+def get_page_params(request):
+    before = request.query_params.get('before')
+    limit = request.query_params.get('limit', connections.CONNECTIONS_PAGE_SIZE)
+    before = int(before) if before else None
+    limit = min(int(limit), connections.CONNECTIONS_MAX_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return before, limit
+
+def page_response(items, next_cursor, serializer_class):
+    return Response({
+        'results': serializer_class(items, many=True).data,
+        'next': next_cursor
+        }, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def list_connections(request):
+    try:
+        before, limit = get_page_params(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return page_response(*connections.list_connections(request.user, before, limit), ConnectionSerializer)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def list_incoming_connection_requests(request):
+    try:
+        before, limit = get_page_params(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return page_response(*connections.list_incoming_requests(request.user, before, limit), ConnectionRequestSerializer)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def list_outgoing_connection_requests(request):
+    try:
+        before, limit = get_page_params(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return page_response(*connections.list_outgoing_requests(request.user, before, limit), ConnectionRequestSerializer)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def list_mutual_connections(request, user_id):
+    other = get_object_or_404(CustomUser, id=user_id)
+    try:
+        before, limit = get_page_params(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return page_response(*connections.list_mutual_connections(request.user, other, before, limit), ConnectionSerializer)
 
-def is_otp_valid(user, otp):
-    if not user.otp_created:
-        return False
-    if (timezone.now() - user.otp_created).seconds > OTP_EXPIRATION_TIME * 60:
-        return False
-    return user.otp == otp
 
 class RegisterView(APIView):
     def post(self, request):
@@ -96,10 +280,13 @@ class RegisterView(APIView):
 
         user, created = CustomUser.objects.get_or_create(mobile=mobile, defaults={'is_active': False})
         if created:
-            user.otp = CustomUser.objects._generate_otp()
-            user.otp_created = timezone.now()
-            user.save()
-            send_otp(mobile, user.otp)
+            try:
+                otp = get_otp_store().issue(mobile)
+                send_otp(mobile, otp)
+            except OTPRateLimited as e:
+                return Response({'error': str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            except OTPQueueFull as e:
+                return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
             return Response({
                 'message': f'OTP sent to the mobile number {mobile}',
                 'status': True
@@ -107,10 +294,13 @@ class RegisterView(APIView):
         else:
             # Send OTP again if the user is not active yet
             if not user.is_active:
-                user.otp = CustomUser.objects._generate_otp()
-                user.otp_created = timezone.now()
-                user.save()
-                send_otp(mobile, user.otp)
+                try:
+                    otp = get_otp_store().issue(mobile)
+                    send_otp(mobile, otp)
+                except OTPRateLimited as e:
+                    return Response({'error': str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+                except OTPQueueFull as e:
+                    return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
                 return Response({
                     'message': 'OTP resent, please verify to activate your account',
                     'status': True
@@ -128,19 +318,26 @@ class LoginView(APIView):
                 }, status=status.HTTP_400_BAD_REQUEST)
 
         # user, created = CustomUser.objects.get_or_create(mobile=mobile)
-        try:
-            user = CustomUser.objects.get(mobile=mobile)
-        except CustomUser.DoesNotExist:
+        if not CustomUser.objects.filter(mobile=mobile).exists():
             return Response({
                 'error': 'User not found. Please register your account first.',
                 'status': False
                 }, status=status.HTTP_404_NOT_FOUND)
 
         # Generate and send OTP
-        user.otp = CustomUser.objects._generate_otp()
-        user.otp_created = timezone.now()
-        user.save()
-        send_otp(mobile, user.otp)
+        try:
+            otp = get_otp_store().issue(mobile)
+            send_otp(mobile, otp)
+        except OTPRateLimited as e:
+            return Response({
+                'error': str(e),
+                'status': False
+                }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        except OTPQueueFull as e:
+            return Response({
+                'error': str(e),
+                'status': False
+                }, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
         return Response({
             'message': 'OTP sent to the mobile number',
             'status': True
@@ -153,9 +350,15 @@ class VerifyOTPView(APIView):
         if not mobile or not otp:
             return Response({'error': 'Mobile number and OTP are required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        user = CustomUser.objects.filter(mobile=mobile).first()
-        if user and is_otp_valid(user, otp):
-            user.verify_otp(otp)  # Activate the user if OTP is valid
+        # The store consumes the OTP and counts attempts, only a valid OTP
+        # costs a query
+        try:
+            verified = get_otp_store().verify(mobile, otp)
+        except OTPRateLimited as e:
+            return Response({'error': str(e)}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        user = CustomUser.objects.filter(mobile=mobile).first() if verified else None
+        if user is not None:
+            user.activate()
 
             # Generate JWT token for login
             refresh = RefreshToken.for_user(user)
@@ -176,6 +379,7 @@ class LogoutView(APIView):
             refresh_token = request.data.get('refresh')
             token = RefreshToken(refresh_token)
             token.blacklist()
+            invalidate_user(token[api_settings.USER_ID_CLAIM])
             return Response({'message': 'Logged out successfully'}, status=status.HTTP_205_RESET_CONTENT)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -199,13 +403,10 @@ class SetUsernameView(APIView):
             return Response({'error': 'This username is already taken'}, status=status.HTTP_409_CONFLICT)
 
         user.username = username
-        generate_qr_code(user)  # Generate QR code
-        user.save()
-
-        qr_code_url = request.build_absolute_uri(user.qr_code.url)
-        # Clean the url to get the only image
-        qr_code_url = qr_code_url.split('?')[0]
+        generate_qr_code(user)  # Generate QR code in the background
+        user.save(update_fields=['username', 'qr_code'])
 
+        qr_code_url = get_media_url(user.qr_code.name, request)
 
         refresh = RefreshToken.for_user(user)  # Generate JWT token for login
 
@@ -230,16 +431,7 @@ class UserView(APIView):
     
 class PublicUserView(APIView):
     def get(self, request, username):
-        try:
-            user = CustomUser.objects.get(username=username)
-            serializer = PublicUserSerializer(user)
-            qr_code_url = request.build_absolute_uri(user.qr_code.url)
-            # Clean the url to get the only image
-            qr_code_url = qr_code_url.split('?')[0]
-
-            new_data = serializer.data
-            new_data['qr_code_url'] = qr_code_url
-            return Response({'user': new_data}, status=status.HTTP_200_OK)
-        except CustomUser.DoesNotExist:
+        new_data = get_public_profile(username, request)
+        if new_data is None:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
-        
\ No newline at end of file
+        return Response({'user': new_data}, status=status.HTTP_200_OK)
@@ -1,24 +1,31 @@
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 
-from chat.routing import websocket_urlpatterns
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_project.settings")
 # Initialize Django ASGI application early to ensure the AppRegistry
 # is populated before importing code that may import ORM models.
 django_asgi_app = get_asgi_application()
 
-import chat.routing
+from chat.routing import websocket_urlpatterns
+from chat.lifespan import LifespanApp, install_reactor_shutdown
+from chat.middleware import JWTAuthMiddlewareStack
+from chat.otp import get_otp_dispatcher
 
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
         "websocket": AllowedHostsOriginValidator(
-            AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+            JWTAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
         ),
+        "lifespan": LifespanApp(),
     }
-)
\ No newline at end of file
+)
+
+# Drain the write-behind buffers on shutdown under daphne too
+install_reactor_shutdown()
+
+# Build the OTP sender now, so a server missing its credentials doesn't start
+get_otp_dispatcher()
\ No newline at end of file
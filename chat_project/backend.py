@@ -1,16 +1,17 @@
 from django.contrib.auth.backends import ModelBackend
 from chat.models import CustomUser
+from chat.otp import get_otp_store, OTPRateLimited
+from chat.principals import get_cached_user
 
 class OTPAuthenticationBackend(ModelBackend):
     def authenticate(self, request, mobile=None, otp=None, **kwargs):
         try:
-            user = CustomUser.objects.get(mobile=mobile, otp=otp)
+            if not get_otp_store().verify(mobile, otp):
+                return None
+            user = CustomUser.objects.get(mobile=mobile)
             return user
-        except CustomUser.DoesNotExist:
+        except (CustomUser.DoesNotExist, OTPRateLimited):
             return None
 
     def get_user(self, user_id):
-        try:
-            return CustomUser.objects.get(pk=user_id)
-        except CustomUser.DoesNotExist:
-            return None
\ No newline at end of file
+        return get_cached_user(user_id)
\ No newline at end of file
@@ -62,6 +62,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",
+    "chat.middleware.RequestMetricsMiddleware",
 ]
 
 ROOT_URLCONF = 'chat_project.urls'
@@ -163,6 +164,157 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Room presence and language registry. Uses the channel layer's Redis when
+# there is one, set PRESENCE_STORE to a store class path to override it.
+PRESENCE_STORE = None
+PRESENCE_TTL = 90  # seconds without a heartbeat before a member expires
+PRESENCE_HEARTBEAT_INTERVAL = 30  # seconds
+
+# Chat messages are saved by a write-behind buffer, flushed with one
+# bulk_create per batch. Batches that fail to save are retried with backoff.
+MESSAGE_WRITE_BATCH_SIZE = 100
+MESSAGE_WRITE_INTERVAL = 0.5  # seconds
+MESSAGE_WRITE_MAX_QUEUE = 10000  # messages buffered per process
+MESSAGE_WRITE_RETRIES = 3
+MESSAGE_WRITE_RETRY_DELAY = 0.5  # seconds, doubled per retry
+
+# Room history pages, and the most messages replayed on connect with
+# ?history=N
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+HISTORY_REPLAY_MAX = 50
+HISTORY_BACKFILL_SIZE = 200  # messages translated when a language first joins a room
+
+# Translation backend used in process by the chat consumers and the
+# translate_text view. Use 'chat.translate.StubTranslateBackend' for tests
+# and benchmarks, or 'chat.translate.HttpTranslateBackend' with a 'url'
+# option for a remote translation API.
+TRANSLATION_BACKEND = 'chat.translate.GoogleTranslateBackend'
+TRANSLATION_BACKEND_OPTIONS = {}
+
+# Every translation backend sits behind a circuit breaker that opens after
+# TRANSLATION_BREAKER_FAILURES consecutive failures and probes again after
+# TRANSLATION_BREAKER_RECOVERY. Calls slower than the backend's recent
+# TRANSLATION_HEDGE_PERCENTILE latency (clamped to the hedge delays) are
+# also sent to the next of TRANSLATION_FALLBACK_BACKENDS, which take over
+# while the breakers before them are open. Entries are
+# {'BACKEND': dotted path, 'OPTIONS': {...}, 'NAME': label}.
+TRANSLATION_FALLBACK_BACKENDS = []
+TRANSLATION_BACKEND_TIMEOUT = 10  # seconds per call
+TRANSLATION_BREAKER_FAILURES = 5
+TRANSLATION_BREAKER_RECOVERY = 30  # seconds
+TRANSLATION_HEDGE_PERCENTILE = 95
+TRANSLATION_HEDGE_MIN_DELAY = 0.05  # seconds
+TRANSLATION_HEDGE_MAX_DELAY = 2  # seconds
+TRANSLATION_LATENCY_WINDOW = 200  # calls
+
+# Chat messages whose translations take longer than this are delivered in
+# the original, marked pending, and followed by an update frame with the
+# translation once it arrives
+TRANSLATION_DELIVERY_TIMEOUT = 0.5  # seconds
+
+# Bounds on the translate_text view: concurrent upstream translations,
+# requests allowed to queue behind them and how long they may wait before
+# a 503 is returned. Blocking backends run on at most TRANSLATION_MAX_WORKERS
+# threads.
+TRANSLATION_MAX_CONCURRENCY = 16
+TRANSLATION_MAX_QUEUE = 64
+TRANSLATION_QUEUE_TIMEOUT = 2  # seconds
+TRANSLATION_MAX_WORKERS = 8
+TRANSLATION_BATCH_MAX_ITEMS = 500  # texts x languages per batch request
+
+# Translation cache: a bounded in-process LRU in front of the Redis used by
+# the channel layer (or REDIS_URL when set)
+TRANSLATION_CACHE_SIZE = 10000  # entries per process
+TRANSLATION_CACHE_TTL = 3600  # seconds
+TRANSLATION_CACHE_REDIS = True
+TRANSLATION_CACHE_REDIS_TTL = 86400  # seconds
+
+# Source language the translator detected for a sender, per user and
+# preferred language, so it isn't detected again on every message
+SOURCE_LANGUAGE_CACHE_TTL = 24 * 60 * 60  # seconds
+SOURCE_LANGUAGE_MIN_LENGTH = 20  # characters, shorter messages aren't trusted
+
+# Romanized pronunciation fallbacks of up to DIACRITICS_CACHE_MAX_LENGTH
+# characters are memoized, DIACRITICS_CACHE_SIZE of them
+DIACRITICS_CACHE_SIZE = 4096
+DIACRITICS_CACHE_MAX_LENGTH = 1000  # characters
+
+# Shared keep-alive connection pool for outgoing translation requests
+TRANSLATE_HTTP_POOL_SIZE = 100
+TRANSLATE_HTTP_KEEPALIVE = 30  # seconds
+TRANSLATE_HTTP_TIMEOUT = 10  # seconds
+
+# Django cache, shared by every worker through the channel layer's Redis
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+    }
+}
+
+# Cached public profiles, and an optional CDN in front of the media bucket
+# used to build stable QR code URLs
+PUBLIC_PROFILE_CACHE_TTL = 3600  # seconds
+MEDIA_CDN_URL = None
+
+# Connection and connection request list pages
+CONNECTIONS_PAGE_SIZE = 50
+CONNECTIONS_MAX_PAGE_SIZE = 200
+
+# Notification events are coalesced and delivered in batches of at most
+# NOTIFICATION_BATCH_SIZE, at most NOTIFICATION_BATCH_WINDOW after the first
+NOTIFICATION_BATCH_WINDOW = 0.25  # seconds
+NOTIFICATION_BATCH_SIZE = 50
+
+# Chat WebSocket clients may opt into msgpack binary frames with the
+# babel.msgpack subprotocol or ?format=msgpack. With babel.msgpack+zlib or
+# &compress=zlib, frames of at least WEBSOCKET_COMPRESSION_MIN_SIZE bytes are
+# zlib compressed
+WEBSOCKET_COMPRESSION_MIN_SIZE = 512  # bytes
+WEBSOCKET_COMPRESSION_LEVEL = 6
+WEBSOCKET_MAX_FRAME_SIZE = 1024 * 1024  # bytes, decompressed
+
+# Each chat WebSocket holds at most OUTBOUND_MAX_QUEUE undelivered messages,
+# sent in frames of up to OUTBOUND_BATCH_SIZE collected over
+# OUTBOUND_BATCH_WINDOW. When the queue is full, OUTBOUND_OVERFLOW_POLICY
+# either drops the oldest message ('drop_oldest'), closes the connection
+# ('disconnect') or drops the oldest and stops translating for the client
+# until it catches up ('degrade')
+OUTBOUND_MAX_QUEUE = 256
+OUTBOUND_BATCH_WINDOW = 0.02  # seconds
+OUTBOUND_BATCH_SIZE = 50
+OUTBOUND_OVERFLOW_POLICY = 'drop_oldest'
+
+# Chat messages get a per-room sequence number, and the last ROOM_BUFFER_SIZE
+# messages of a room are kept in Redis (in memory without REDIS_URL) so
+# clients can reconnect with ?since=<seq>. ROOM_BUFFER_STORE selects another
+# store class
+ROOM_BUFFER_SIZE = 500
+ROOM_BUFFER_TTL = 24 * 60 * 60  # seconds since the last message, sequence numbers don't expire
+
+# Prometheus metrics of each worker are served at /chat/metrics/, only to
+# the addresses in METRICS_ALLOWED_IPS. Add the scraper's address, or set it
+# to None to serve every client.
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '{asctime} {levelname} {name} {message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'chat': {'handlers': ['console'], 'level': os.environ.get('CHAT_LOG_LEVEL', 'INFO')},
+    },
+}
+
+# Authenticated users are cached by id for JWT, session and WebSocket auth
+USER_CACHE_TTL = 60  # seconds
+
 AUTHENTICATION_BACKENDS = [
     'chat_project.backend.OTPAuthenticationBackend',
     'django.contrib.auth.backends.ModelBackend'
@@ -170,12 +322,42 @@ AUTHENTICATION_BACKENDS = [
 
 OTP_EXPIRATION_TIME = 5  # minutes
 
+# Issued OTPs live in Redis with a native TTL (the channel layer's Redis by
+# default), or on the user row when there is no Redis. Set OTP_STORE to a
+# store class path to override it.
+OTP_STORE = None
+OTP_MAX_ATTEMPTS = 5  # verification attempts per OTP
+OTP_ISSUE_LIMIT = 5  # OTPs per mobile number and window
+OTP_ISSUE_WINDOW = 3600  # seconds
+
+# OTPs are sent by background workers through OTP_SENDER_BACKEND. Use
+# 'chat.otp.FakeOTPSender' for tests and benchmarks.
+OTP_SENDER_BACKEND = 'chat.otp.TwilioOTPSender'
+OTP_SEND_WORKERS = 4
+OTP_SEND_RETRIES = 3
+OTP_SEND_BACKOFF = 0.5  # seconds, doubled on every retry
+
+# Twilio credentials come from the environment only, the ASGI and WSGI
+# applications refuse to start without them. OTPs that can't be queued for
+# sending are answered with 503.
+TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
+TWILIO_FROM_NUMBER = '+12054988451'
+
+# QR codes are rendered and uploaded by background workers, and the
+# rendered images of recent profiles are kept in memory. Failed uploads are
+# retried, then the user's QR code is cleared so it is generated again.
+QR_CODE_WORKERS = 2
+QR_CODE_CACHE_SIZE = 1024
+QR_CODE_UPLOAD_ATTEMPTS = 3
+QR_CODE_UPLOAD_RETRY_DELAY = 1  # seconds, doubled per retry
+
 CORS_ORIGIN_ALLOW_ALL = True
 
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chat.authentication.CachedJWTAuthentication',
     ),
  
 }
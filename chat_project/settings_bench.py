@@ -0,0 +1,60 @@
+"""
+Settings for the benchmark commands. Everything runs locally: SQLite, the
+in-memory channel layer (or a local Redis with BENCH_REDIS_URL), a stub
+translator with BENCH_TRANSLATION_LATENCY seconds of latency and a fake OTP
+sender, so results are reproducible on one machine.
+
+    python manage.py migrate --settings=chat_project.settings_bench
+    python manage.py bench_chat --settings=chat_project.settings_bench
+    python manage.py bench_micro --settings=chat_project.settings_bench
+"""
+import os
+import tempfile
+
+from .settings import *  # noqa
+
+DEBUG = False
+ALLOWED_HOSTS = ['*']
+
+BENCH_DIR = os.environ.get('BENCH_DIR', os.path.join(tempfile.gettempdir(), 'chatappbabel-bench'))
+os.makedirs(BENCH_DIR, exist_ok=True)
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCH_DIR, 'db.sqlite3'),
+    }
+}
+
+BENCH_REDIS_URL = os.environ.get('BENCH_REDIS_URL')
+REDIS_URL = BENCH_REDIS_URL
+if BENCH_REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [BENCH_REDIS_URL]},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': 10000},
+        },
+    }
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+TRANSLATION_BACKEND = 'chat.translate.StubTranslateBackend'
+TRANSLATION_BACKEND_OPTIONS = {'latency': float(os.environ.get('BENCH_TRANSLATION_LATENCY', '0.05'))}
+
+OTP_SENDER_BACKEND = 'chat.otp.FakeOTPSender'
+OTP_ISSUE_LIMIT = 1000000
+OTP_MAX_ATTEMPTS = 1000000
+
+DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+MEDIA_ROOT = os.path.join(BENCH_DIR, 'media')
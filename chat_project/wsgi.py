@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings')
 
 application = get_wsgi_application()
+
+from chat.otp import get_otp_dispatcher
+
+# Build the OTP sender now, so a server missing its credentials doesn't start
+get_otp_dispatcher()